@@ -0,0 +1,58 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class CachedPage(object):
+    def __init__(self, body, generation):
+        self.body = body
+        self.generation = generation
+        self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.last_modified = int(time.time())
+        # Compressed variants of body by content encoding
+        self.encoded = {}
+
+    def __len__(self):
+        return len(self.body)
+
+
+class PageCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def get(self, key, generation):
+        page = self._pages.get(key)
+        if page is None or page.generation != generation:
+            # Stale pages stay until replaced, put() needs their validators
+            self.misses += 1
+            return None
+        # Re-insert to mark as most recently used
+        del self._pages[key]
+        self._pages[key] = page
+        self.hits += 1
+        return page
+
+    def put(self, key, body, generation):
+        page = CachedPage(body, generation)
+        old = self._pages.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+            if old.etag == page.etag:
+                # Same content, keep validators stable for conditional GETs
+                page.last_modified = old.last_modified
+                page.encoded = old.encoded
+        if len(page) <= self.max_bytes:
+            self._pages[key] = page
+            self.size += len(page)
+            while self.size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= len(evicted)
+        return page
+
+    def clear(self):
+        self._pages.clear()
+        self.size = 0
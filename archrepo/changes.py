@@ -0,0 +1,77 @@
+import gevent
+import logging
+from gevent.socket import wait_read
+from psycopg2 import extensions
+
+
+PACKAGES = 'archrepo_packages'
+USERS = 'archrepo_users'
+CHANNELS = (PACKAGES, USERS)
+
+
+def notify(cur, channel):
+    # Delivered to listeners in every process once the transaction commits
+    cur.execute('NOTIFY %s' % channel)
+
+
+class ChangeListener(object):
+    def __init__(self, pool, channels=CHANNELS, retry=5):
+        self.pool = pool
+        self.generations = dict.fromkeys(channels, 0)
+        self.retry = retry
+        self.listeners = []
+        self._greenlet = None
+
+    def generation(self, channel):
+        return self.generations[channel]
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._work)
+
+    def kill(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def _bump(self, channel):
+        self.generations[channel] += 1
+        for l in self.listeners:
+            l(channel, self.generations[channel])
+
+    def _work(self):
+        while True:
+            conn = None
+            try:
+                # A dedicated connection, it never goes back to the pool
+                conn = self.pool.create_connection()
+                conn.set_isolation_level(
+                    extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                for channel in self.generations:
+                    cur.execute('LISTEN %s' % channel)
+                # Anything could have changed while we were not listening
+                for channel in self.generations:
+                    self._bump(channel)
+                while True:
+                    wait_read(conn.fileno())
+                    conn.poll()
+                    channels = set()
+                    while conn.notifies:
+                        channels.add(conn.notifies.pop().channel)
+                    for channel in channels:
+                        if channel in self.generations:
+                            self._bump(channel)
+            except Exception:
+                logging.error('Lost change notification connection',
+                              exc_info=True)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            gevent.sleep(self.retry)
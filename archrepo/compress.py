@@ -0,0 +1,176 @@
+import cherrypy
+import hashlib
+import mimetypes
+import os
+import zlib
+from cherrypy.lib import cptools
+
+from archrepo import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'text/css',
+                      'text/javascript', 'application/javascript',
+                      'application/json', 'image/svg+xml')
+
+
+class Compression(object):
+    def __init__(self):
+        self.enabled = config.xgetbool('web', 'compress', True)
+        self.level = config.xgetint('web', 'compress-level', 6)
+        self.brotli_quality = config.xgetint('web', 'compress-brotli-quality',
+                                             5)
+        self.min_size = config.xgetint('web', 'compress-min-size', 1024)
+        # Preferred first, brotli only if the module is installed
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+    def negotiate(self, accept_encoding, size=None):
+        if not self.enabled or not accept_encoding:
+            return None
+        if size is not None and size < self.min_size:
+            return None
+        accepted = {}
+        for part in accept_encoding.split(','):
+            coding, _, params = part.partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0
+            accepted[coding.strip().lower()] = q
+        for encoding in self.encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+
+    def compress(self, body, encoding, best=False):
+        if encoding == 'br':
+            return brotli.compress(
+                body, quality=11 if best else self.brotli_quality)
+        # wbits of 16 + MAX_WBITS writes the gzip header and trailer
+        c = zlib.compressobj(9 if best else self.level, zlib.DEFLATED,
+                             16 + zlib.MAX_WBITS)
+        return c.compress(body) + c.flush()
+
+    def compressChunks(self, chunks, encoding):
+        if encoding == 'br':
+            c = brotli.Compressor(quality=self.brotli_quality)
+            for chunk in chunks:
+                # Flushed so that streamed rows reach the client early
+                data = c.process(chunk) + c.flush()
+                if data:
+                    yield data
+            yield c.finish()
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED,
+                                 16 + zlib.MAX_WBITS)
+            for chunk in chunks:
+                data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+            yield c.flush()
+
+    def compressResponse(self, mime_types=COMPRESSIBLE_TYPES):
+        request = cherrypy.serving.request
+        response = cherrypy.serving.response
+        if (not self.enabled or not response.body or
+                'Content-Encoding' in response.headers):
+            # Cached pages and static assets are already encoded
+            return
+        content_type = response.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip() not in mime_types:
+            return
+        response.headers['Vary'] = 'Accept-Encoding'
+        accept_encoding = request.headers.get('Accept-Encoding')
+        if response.stream:
+            encoding = self.negotiate(accept_encoding)
+            if encoding is not None:
+                response.body = self.compressChunks(response.body, encoding)
+        else:
+            body = response.collapse_body()
+            encoding = self.negotiate(accept_encoding, len(body))
+            if encoding is not None:
+                response.body = [self.compress(body, encoding)]
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+
+    def send(self, body, etag, encoded):
+        request = cherrypy.serving.request
+        headers = cherrypy.serving.response.headers
+        encoding = self.negotiate(request.headers.get('Accept-Encoding'),
+                                  len(body))
+        if encoding is not None:
+            # Compressed at most once, encoded is kept with the body
+            if encoding not in encoded:
+                encoded[encoding] = self.compress(body, encoding)
+            body = encoded[encoding]
+            # Strong validators must differ between encodings
+            etag = '"%s-%s"' % (etag.strip('"'), encoding)
+            headers['Content-Encoding'] = encoding
+        headers['ETag'] = etag
+        headers['Vary'] = 'Accept-Encoding'
+        return body
+
+
+class StaticAsset(object):
+    def __init__(self, name, body, compression):
+        self.body = body
+        self.digest = hashlib.sha1(body).hexdigest()[:12]
+        self.content_type = (mimetypes.guess_type(name)[0] or
+                             'application/octet-stream')
+        self.encoded = {}
+        if self.content_type in COMPRESSIBLE_TYPES:
+            # Compressed once, with the slowest and smallest settings
+            for encoding in compression.encodings:
+                self.encoded[encoding] = compression.compress(
+                    body, encoding, best=True)
+
+
+class StaticAssets(object):
+    def __init__(self, path, compression):
+        self.compression = compression
+        self.max_age = config.xgetint('web', 'static-max-age', 31536000)
+        self._assets = {}
+        self._urls = {}
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if not os.path.isfile(filename):
+                continue
+            with open(filename, 'rb') as f:
+                asset = StaticAsset(name, f.read(), compression)
+            root, ext = os.path.splitext(name)
+            hashed = '%s.%s%s' % (root, asset.digest, ext)
+            self._assets[name] = self._assets[hashed] = asset
+            self._urls[name] = hashed
+
+    def url(self, name):
+        return self._urls.get(name, name)
+
+    @cherrypy.expose
+    def default(self, *path):
+        name = '/'.join(path)
+        asset = self._assets.get(name)
+        if asset is None:
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = asset.content_type
+        if name in self._urls:
+            # Old URL, the content may change without the URL changing
+            headers['Cache-Control'] = 'public, max-age=0'
+        else:
+            headers['Cache-Control'] = 'public, max-age=%d, immutable' % (
+                self.max_age)
+        body = asset.body
+        if asset.content_type in COMPRESSIBLE_TYPES:
+            body = self.compression.send(body, '"%s"' % asset.digest,
+                                         asset.encoded)
+        else:
+            headers['ETag'] = '"%s"' % asset.digest
+        cptools.validate_etags()
+        return body
@@ -0,0 +1,22 @@
+from babel.core import Locale, default_locale
+from babel.dates import format_date
+from datetime import datetime
+
+
+class DateFormatter(object):
+    def __init__(self, locale=None, size=4096):
+        # Parsed once, format_date() would resolve a locale name every call
+        self.locale = Locale.parse(locale or default_locale('LC_TIME'))
+        self.size = size
+        self._dates = {}
+
+    def __call__(self, value):
+        if isinstance(value, datetime):
+            value = value.date()
+        result = self._dates.get(value)
+        if result is None:
+            if len(self._dates) >= self.size:
+                self._dates.clear()
+            result = self._dates[value] = format_date(value,
+                                                      locale=self.locale)
+        return result
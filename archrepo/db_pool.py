@@ -76,7 +76,9 @@ class DatabaseConnectionPool(object):
                 if conn.isolation_level == isolation_level:
                     isolation_level = None
                 else:
+                    old_level = conn.isolation_level
                     conn.set_isolation_level(isolation_level)
+                    isolation_level = old_level
             yield conn
         except:
             if conn.closed:
@@ -104,7 +106,9 @@ class DatabaseConnectionPool(object):
                 if conn.isolation_level == isolation_level:
                     isolation_level = None
                 else:
+                    old_level = conn.isolation_level
                     conn.set_isolation_level(isolation_level)
+                    isolation_level = old_level
             yield conn.cursor(*args, **kwargs)
         except:
             if conn.closed:
@@ -147,10 +151,11 @@ class DatabaseConnectionPool(object):
             return cursor.fetchall()
 
     def fetchiter(self, *args, **kwargs):
+        size = kwargs.pop('size', None)
         with self.cursor(**kwargs) as cursor:
             cursor.execute(*args)
             while True:
-                items = cursor.fetchmany()
+                items = cursor.fetchmany(size or cursor.arraysize)
                 if not items:
                     break
                 for item in items:
@@ -0,0 +1,296 @@
+import errno
+import logging
+import os
+import time
+import gevent
+from collections import OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+from cherrypy.lib import httputil
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+from sendfile import sendfile
+
+from archrepo import config
+
+
+class OpenFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        st = os.fstat(self.fd)
+        self.key = st.st_ino, st.st_size, int(st.st_mtime)
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = '"%x-%x-%x"' % self.key
+        self.users = 0
+        self.evicted = False
+
+    def release(self):
+        self.users -= 1
+        if self.evicted and not self.users:
+            os.close(self.fd)
+
+    def evict(self):
+        self.evicted = True
+        if not self.users:
+            os.close(self.fd)
+
+
+class FileCache(object):
+    def __init__(self, size):
+        self.size = size
+        self._files = OrderedDict()
+
+    def open(self, path):
+        f = self._files.pop(path, None)
+        if f is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or (st.st_ino, st.st_size,
+                              int(st.st_mtime)) != f.key:
+                # Removed or replaced since it was opened
+                f.evict()
+                f = None
+        if f is None:
+            f = OpenFile(path)
+        self._files[path] = f
+        while len(self._files) > self.size:
+            _, evicted = self._files.popitem(last=False)
+            evicted.evict()
+        f.users += 1
+        return f
+
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._next = {}
+
+    def wait(self, client, size):
+        now = time.time()
+        start = max(now, self._next.get(client, now))
+        # Concurrent downloads of the same client share its bandwidth
+        self._next[client] = start + size / self.rate
+        if len(self._next) > 1024:
+            for key, value in self._next.items():
+                if value < now:
+                    del self._next[key]
+        if start > now:
+            gevent.sleep(start - now)
+
+
+class FileBody(object):
+    def __init__(self, f, offset, length, chunk_size, limiter=None,
+                 client=None):
+        self.file = f
+        self.offset = offset
+        self.length = length
+        self.chunk_size = chunk_size
+        self.limiter = limiter
+        self.client = client
+
+    def _slices(self):
+        offset, end = self.offset, self.offset + self.length
+        while offset < end:
+            size = min(self.chunk_size, end - offset)
+            if self.limiter is not None:
+                self.limiter.wait(self.client, size)
+            yield offset, size
+            offset += size
+
+    def __iter__(self):
+        # Only used by servers without DownloadHandler
+        for offset, size in self._slices():
+            os.lseek(self.file.fd, offset, os.SEEK_SET)
+            data = os.read(self.file.fd, size)
+            if not data:
+                break
+            yield data
+
+    def sendTo(self, sock):
+        fileno = sock.fileno()
+        total = 0
+        for offset, size in self._slices():
+            while size:
+                try:
+                    sent = sendfile(fileno, self.file.fd, offset, size)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    wait_write(fileno)
+                    continue
+                if not sent:
+                    # Truncated under us, the client will see a short body
+                    return total
+                offset += sent
+                size -= sent
+                total += sent
+        return total
+
+    def close(self):
+        if self.file is not None:
+            self.file.release()
+            self.file = None
+
+
+class DownloadHandler(WSGIHandler):
+    def process_result(self):
+        if isinstance(self.result, FileBody):
+            # Headers go out as usual, the kernel copies the file to the socket
+            self.write('')
+            self.response_length += self.result.sendTo(self.socket)
+        else:
+            WSGIHandler.process_result(self)
+
+
+def parseRange(value, size):
+    if not value or not value.startswith('bytes=') or ',' in value:
+        # Multiple ranges are allowed to be answered with the whole file
+        return None
+    start, sep, end = value[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return ()
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return ()
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def parseDate(value):
+    parsed = value and parsedate_tz(value)
+    if parsed:
+        return mktime_tz(parsed)
+
+
+class PackageDownloads(object):
+    prefix = '/download/'
+
+    def __init__(self, pool, app):
+        self.pool = pool
+        self.app = app
+        self.files = FileCache(
+            config.xgetint('web', 'download-fd-cache-size', 64))
+        self.chunk_size = config.xgetint(
+            'web', 'download-chunk-size', 1024) * 1024
+        rate = config.xgetint('web', 'download-rate-limit', 0)
+        self.limiter = RateLimiter(rate * 1024) if rate > 0 else None
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.app(environ, start_response)
+        try:
+            return self._download(environ, start_response,
+                                  path[len(self.prefix):])
+        except Exception:
+            logging.error('Failed serving %s', path, exc_info=True)
+            return self._error(start_response, '500 Internal Server Error')
+
+    def _error(self, start_response, status, headers=()):
+        start_response(status, [('Content-Type', 'text/plain'),
+                                ('Content-Length', str(len(status)))] +
+                               list(headers))
+        return [status]
+
+    def _findFile(self, arch, name, version):
+        with self.pool.cursor() as cur:
+            if version is None:
+                cur.execute('SELECT file_path FROM packages '
+                             'WHERE name=%s AND arch IN (%s, \'any\') '
+                               'AND latest '
+                             'ORDER BY arch=%s DESC LIMIT 1',
+                            (name, arch, arch))
+            else:
+                cur.execute('SELECT file_path FROM packages '
+                             'WHERE name=%s AND arch IN (%s, \'any\') '
+                               'AND version=%s AND enabled '
+                             'ORDER BY arch=%s DESC LIMIT 1',
+                            (name, arch, version, arch))
+            result = cur.fetchone()
+        return result and result[0]
+
+    def _download(self, environ, start_response, path):
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            return self._error(start_response, '405 Method Not Allowed',
+                               [('Allow', 'GET, HEAD')])
+        parts = path.strip('/').split('/')
+        if len(parts) not in (2, 3) or not all(parts):
+            return self._error(start_response, '404 Not Found')
+        arch, name = parts[:2]
+        version = parts[2] if len(parts) == 3 else None
+        file_path = self._findFile(arch, name, version)
+        if not file_path:
+            return self._error(start_response, '404 Not Found')
+        try:
+            f = self.files.open(file_path)
+        except (IOError, OSError):
+            logging.warning('Cannot open %s for download', file_path)
+            return self._error(start_response, '404 Not Found')
+
+        try:
+            headers = [
+                ('ETag', f.etag),
+                ('Last-Modified', httputil.HTTPDate(f.mtime)),
+                ('Accept-Ranges', 'bytes')]
+            if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+            if if_none_match is not None:
+                not_modified = if_none_match.strip() == '*' or f.etag in [
+                    x.strip() for x in if_none_match.split(',')]
+            else:
+                since = parseDate(environ.get('HTTP_IF_MODIFIED_SINCE'))
+                not_modified = since is not None and f.mtime <= since
+            if not_modified:
+                start_response('304 Not Modified', headers)
+                f.release()
+                return []
+
+            byte_range = parseRange(environ.get('HTTP_RANGE'), f.size)
+            if_range = environ.get('HTTP_IF_RANGE')
+            if byte_range is not None and if_range is not None:
+                # Resume only if the client still has the same file
+                if if_range.startswith('"'):
+                    if if_range != f.etag:
+                        byte_range = None
+                elif parseDate(if_range) != f.mtime:
+                    byte_range = None
+            if byte_range == ():
+                f.release()
+                return self._error(
+                    start_response, '416 Requested Range Not Satisfiable',
+                    headers + [('Content-Range', 'bytes */%d' % f.size)])
+            if byte_range is None:
+                status = '200 OK'
+                offset, length = 0, f.size
+            else:
+                status = '206 Partial Content'
+                offset, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+                headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+                    byte_range[0], byte_range[1], f.size)))
+            headers.extend([
+                ('Content-Type', 'application/octet-stream'),
+                ('Content-Length', str(length)),
+                ('Content-Disposition',
+                 'attachment; filename="%s"' % os.path.basename(file_path))])
+            start_response(status, headers)
+        except Exception:
+            f.release()
+            raise
+        if method == 'HEAD':
+            f.release()
+            return []
+        return FileBody(f, offset, length, self.chunk_size, self.limiter,
+                        environ.get('REMOTE_ADDR'))
@@ -0,0 +1,150 @@
+import cherrypy
+import gevent
+import greenlet
+import logging
+import sys
+import thread
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from archrepo import config
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+def _foldStack(frame):
+    names = []
+    while frame is not None:
+        names.append(_frameName(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+class HubMonitor(object):
+    # Runs in a real thread, which still gets to run while a greenlet keeps
+    # the hub from switching
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._thread_id = None
+        self._hub = None
+        self._active = None
+        self._switched = time.time()
+        self._switches = 0
+        self._previous_trace = None
+
+    def start(self):
+        self._thread_id = thread.get_ident()
+        self._hub = gevent.get_hub()
+        self._previous_trace = greenlet.settrace(self._trace)
+        monitor = threading.Thread(target=self._run, name='hub-monitor')
+        monitor.daemon = True
+        monitor.start()
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            self._active = args[1]
+            self._switched = time.time()
+            self._switches += 1
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _run(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 2.0)
+            switches, active = self._switches, self._active
+            if (active is None or active is self._hub or
+                    switches == reported):
+                continue
+            blocked = time.time() - self._switched
+            if blocked < self.threshold:
+                continue
+            reported = switches
+            frame = sys._current_frames().get(self._thread_id)
+            logging.warning(
+                'Greenlet %r has blocked the hub for %.3f seconds:\n%s',
+                active, blocked, ''.join(traceback.format_stack(frame)))
+
+
+class SamplingProfiler(object):
+    def __init__(self):
+        self._thread_id = thread.get_ident()
+        self._running = False
+
+    def profile(self, seconds, interval):
+        # Collapsed stacks of the hub thread, one "a;b;c count" per line, as
+        # read by flamegraph.pl and most flame graph viewers
+        if self._running:
+            raise RuntimeError('Already profiling')
+        self._running = True
+        samples = defaultdict(int)
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample,
+                                   args=(samples, interval, stop))
+        sampler.daemon = True
+        try:
+            sampler.start()
+            gevent.sleep(seconds)
+        finally:
+            stop.set()
+            while sampler.is_alive():
+                gevent.sleep(interval)
+            self._running = False
+        return ''.join('%s %d\n' % x for x in sorted(samples.iteritems()))
+
+    def _sample(self, samples, interval, stop):
+        while not stop.is_set():
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                samples[_foldStack(frame)] += 1
+            del frame
+            time.sleep(interval)
+
+
+class AdminPages(object):
+    def __init__(self, app):
+        self.app = app
+        self.admins = set([int(x) for x in config.xget(
+            'web', 'admins', default='').split(',') if x.strip()])
+        self.max_seconds = config.xgetint('web', 'profile-max-seconds', 60)
+        self.profiler = SamplingProfiler()
+
+    def _checkAdmin(self):
+        userinfo = self.app.auth.getUserInfo()
+        if userinfo is None or userinfo['id'] not in self.admins:
+            raise cherrypy.HTTPError(403)
+
+    @cherrypy.expose
+    def profile(self, seconds='10', interval='5', target=None):
+        # Only this web worker, unless the processor is asked for, which
+        # runs in another process with more than one web workers
+        self._checkAdmin()
+        try:
+            seconds = min(self.max_seconds, max(1, int(seconds)))
+            interval = min(1000, max(1, int(interval))) / 1000.0
+        except ValueError:
+            raise cherrypy.HTTPError(400)
+        if target == 'processor':
+            # archrepo.repo imports this module
+            from archrepo.repo import ManagementClient, ManagementError
+            try:
+                body = ManagementClient().call(
+                    'profile', seconds, interval).encode('utf-8')
+            except ManagementError as e:
+                raise cherrypy.HTTPError(503, str(e))
+        elif target is not None:
+            raise cherrypy.HTTPError(400)
+        else:
+            try:
+                body = self.profiler.profile(seconds, interval)
+            except RuntimeError:
+                raise cherrypy.HTTPError(409, 'Already profiling')
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        cherrypy.response.headers['Cache-Control'] = 'no-store'
+        return body
@@ -0,0 +1,54 @@
+import tarfile
+from gzip import GzipFile
+from lzma import LZMAFile
+from zstandard import ZstdDecompressor, ZstdError
+
+
+def _openZstd(path):
+    return ZstdDecompressor().stream_reader(open(path, 'rb'))
+
+
+PACKAGE_FORMATS = (
+    ('.pkg.tar.gz', GzipFile),
+    ('.pkg.tar.xz', LZMAFile),
+    ('.pkg.tar.zst', _openZstd),
+)
+PACKAGE_SUFFIXES = tuple([suffix for suffix, _ in PACKAGE_FORMATS])
+DECODE_ERRORS = (IOError, EOFError, tarfile.TarError, ZstdError)
+READ_SIZE = 64 * 1024
+
+
+def isPackageFile(name):
+    return name.endswith(PACKAGE_SUFFIXES)
+
+
+def openPackage(path):
+    for suffix, opener in PACKAGE_FORMATS:
+        if path.endswith(suffix):
+            return opener(path)
+
+
+def readPkginfo(decoded, verify=False):
+    # Streamed, so nothing is decoded after .PKGINFO unless verifying
+    f = tarfile.open(fileobj=decoded, mode='r|', bufsize=READ_SIZE)
+    while True:
+        info = f.next()
+        if info is None:
+            return None, True
+        if info.name == '.PKGINFO':
+            lines = f.extractfile(info).readlines()
+            break
+    complete = True
+    if verify:
+        try:
+            while f.next() is not None:
+                pass
+            # A tarball cut between two members looks like a shorter one,
+            # only the end of archive block tells them apart
+            complete = f.fileobj.pos - f.offset >= tarfile.BLOCKSIZE
+            # The decoders check their checksums at the end of the stream
+            while decoded.read(READ_SIZE):
+                pass
+        except DECODE_ERRORS:
+            complete = False
+    return lines, complete
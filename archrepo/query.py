@@ -1,5 +1,11 @@
 import logging
+import re
 import time
+import ujson
+import weakref
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+from datetime import datetime
 from gevent import Greenlet
 from gevent import spawn
 from gevent.event import AsyncResult
@@ -10,6 +16,202 @@ from gevent.queue import Queue, Empty
 from archrepo import config
 
 
+SEEK_KEYS = ('last_update', 'name', 'arch', 'flag_date')
+NULLABLE_SEEK_KEYS = ('flag_date',)
+DATE_SEEK_KEYS = ('last_update', 'flag_date')
+
+
+def escapeLike(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def queryKey(sql, values):
+    # Equal for equivalent queries no matter how the values were ordered
+    return sql, tuple(sorted(values.items()))
+
+
+def encodeSeekToken(key, value, id_):
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return b64encode(ujson.dumps([key, value, id_]), '-_').rstrip('=')
+
+
+def decodeSeekToken(token, key):
+    try:
+        token = str(token)
+        _key, value, id_ = ujson.loads(
+            b64decode(token + '=' * (-len(token) % 4), '-_'))
+    except (TypeError, ValueError):
+        return None
+    if (_key != key or isinstance(id_, bool) or
+            not isinstance(id_, (int, long))):
+        return None
+    if value is None:
+        if key not in NULLABLE_SEEK_KEYS:
+            return None
+    elif not isinstance(value, basestring):
+        return None
+    elif key in DATE_SEEK_KEYS:
+        # As written by datetime.isoformat(), which drops zero microseconds
+        for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                value = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                pass
+        else:
+            return None
+    return value, id_
+
+
+def seekCondition(key, value, desc):
+    # Rows strictly after (value, id) in ORDER BY key, id (DESC if desc),
+    # where PostgreSQL sorts NULL as the largest value
+    nullable = key in NULLABLE_SEEK_KEYS
+    if value is None:
+        if desc:
+            return '(%s IS NOT NULL OR id < %%(seek_id)s)' % key
+        else:
+            return '(%s IS NULL AND id > %%(seek_id)s)' % key
+    cond = '(%s, id) %s (%%(seek_value)s, %%(seek_id)s)' % (
+        key, '<' if desc else '>')
+    if nullable and not desc:
+        cond = '(%s OR %s IS NULL)' % (cond, key)
+    return cond
+
+
+class PackageFilter(object):
+    def __init__(self, sort=None, arch=None, maintainer=None, q=None,
+                 flagged=None, last_update=None, name=None, rank=True):
+        self.from_list = ['latest_packages']
+        self.sort_list = []
+        self.where_list = []
+        self.desc = True
+        self.values = {}
+
+        if arch is not None:
+            if not isinstance(arch, list):
+                arch = [arch]
+            arch = sorted(set(arch))
+            self.where_list.append('arch IN %(arch)s')
+            self.values['arch'] = tuple(arch)
+        else:
+            arch = ()
+        self.arch = arch
+
+        if last_update is not None and last_update.strip():
+            last_update = last_update.strip()
+            self.where_list.append('last_update > %(last_update)s')
+            self.values['last_update'] = last_update
+        else:
+            last_update = ''
+        self.last_update = last_update
+
+        if flagged == '1':
+            self.where_list.append('flag_date IS NOT NULL')
+        elif flagged == '2':
+            self.where_list.append('flag_date IS NULL')
+        else:
+            flagged = '0'
+        self.flagged = flagged
+
+        if maintainer is not None and maintainer.isdigit():
+            if int(maintainer):
+                self.where_list.append('owner=%(owner)s')
+                self.values['owner'] = int(maintainer)
+            else:
+                self.where_list.append('owner IS NULL')
+
+        if sort:
+            for part in sort.lower().split(','):
+                if part in SEEK_KEYS:
+                    self.sort_list.append(part)
+                if part in ('name', 'arch', 'asc'):
+                    self.desc = False
+                if part in ('desc',):
+                    self.desc = True
+        if not self.sort_list:
+            self.sort_list.append('last_update')
+            self.desc = True
+
+        if q is not None and q.strip():
+            q = ' '.join(q.split())
+            # plainto_tsquery() ANDs the words and ignores tsquery syntax
+            self.from_list.append('plainto_tsquery(%(lang)s, %(q)s) query')
+            self.values['lang'] = 'english'
+            self.values['q'] = q.lower()
+            self.where_list.append('searchable @@ query')
+            if rank:
+                self.sort_list.append('ts_rank_cd(searchable, query)')
+                self.desc = True
+        else:
+            q = ''
+        self.q = q
+
+        if name is not None and name.strip():
+            # Substrings and typos, served by the trigram indexes
+            name = name.strip().lower()
+            self.values['name'] = name
+            self.values['name_like'] = '%' + escapeLike(name) + '%'
+            self.values['name_prefix'] = escapeLike(name) + '%'
+            self.where_list.append(
+                '(name ILIKE %(name_like)s OR base_name ILIKE %(name_like)s '
+                 'OR name %% %(name)s)')
+            if rank:
+                self.sort_list.append(
+                    '(CASE WHEN name=%(name)s THEN 2 '
+                          'WHEN name LIKE %(name_prefix)s THEN 1 '
+                          'ELSE 0 END) + similarity(name, %(name)s)')
+                self.desc = True
+        else:
+            name = ''
+        self.name = name
+
+    @property
+    def from_where(self):
+        sql = ' FROM ' + ', '.join(self.from_list)
+        if self.where_list:
+            sql = ' WHERE '.join((sql, ' AND '.join(self.where_list)))
+        return sql
+
+    def select(self, fields):
+        sql = 'SELECT ' + ', '.join(fields) + self.from_where
+        if self.sort_list:
+            sql = ' ORDER BY '.join((sql, ', '.join(self.sort_list)))
+            if self.desc:
+                sql = ' '.join((sql, 'DESC'))
+        return sql
+
+
+_plan_rows = re.compile(r'rows=(\d+)')
+
+
+def estimateRows(cur, sql, values):
+    cur.execute('EXPLAIN ' + sql, values)
+    match = _plan_rows.search(cur.fetchone()[0])
+    return int(match.group(1)) if match else None
+
+
+class CountCache(object):
+    def __init__(self, size=1024):
+        self.size = size
+        self._counts = OrderedDict()
+
+    def get(self, key, generation):
+        entry = self._counts.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        del self._counts[key]
+        self._counts[key] = entry
+        return entry[1]
+
+    def put(self, key, generation, value):
+        self._counts.pop(key, None)
+        self._counts[key] = (generation, value)
+        while len(self._counts) > self.size:
+            self._counts.popitem(last=False)
+
+
 class Killed(Exception):
     def __init__(self, result):
         self.result = result
@@ -20,45 +222,47 @@ class ReusableCursor(Greenlet):
     def __init__(self, pool, key, sql, values):
         super(ReusableCursor, self).__init__(self.work)
         self.pool = pool
-        self.key = self._formatted_info = key
+        self.key = key
+        self._formatted_info = str(key)
         self.sql = sql
         self.values = values
         self.offset = 0
+        self.read_ahead = config.xgetbool('web', 'query-read-ahead', True)
+        self._ahead = None
+        self._last = None
         self.queue = Queue()
-        self._count = AsyncResult()
         self.last_access = time.time()
         self.idle = False
-        self.listeners = []
+        # Sub-cursor pools come and go with sessions, never keep them alive
+        self.listeners = weakref.WeakSet()
         self.window = config.xgetint('web', 'query-reusable-window', 30)
 
-    @property
-    def count(self):
-        return self._count.get()
-
     def work(self):
         try:
             with self.pool.connection() as conn:
                 cur = conn.cursor('_cur')
                 cur.execute(self.sql, self.values)
                 logging.debug(cur.query)
-                cur_tmp = conn.cursor()
-                cur_tmp.execute('MOVE ALL FROM _cur')
-                self._count.set(int(cur_tmp.statusmessage.split()[-1]))
-                cur_tmp.close()
-                cur.scroll(0, 'absolute')
                 while True:
+                    if self._ahead is None and not self.queue.qsize():
+                        self._readAhead(cur)
                     if not self.queue.qsize():
                         self.idle = True
-                        for l in self.listeners:
+                        for l in list(self.listeners):
                             spawn(l.onIdle, self)
                     result, limit, offset = self.queue.get(timeout=self.window)
                     self.idle = False
                     if limit is None:
                         raise Killed(result)
-                    if self.offset != offset:
-                        cur.scroll(offset, 'absolute')
-                    data = cur.fetchmany(limit)
-                    self.offset = offset + limit
+                    ahead, self._ahead = self._ahead, None
+                    if ahead is not None and ahead[:2] == (limit, offset):
+                        data = ahead[2]
+                    else:
+                        if self.offset != offset:
+                            cur.scroll(offset, 'absolute')
+                        data = cur.fetchmany(limit)
+                        self.offset = offset + len(data)
+                    self._last = limit, offset, len(data)
                     result.set(data)
                     self.last_access = time.time()
         except Empty:
@@ -68,6 +272,21 @@ class ReusableCursor(Greenlet):
         finally:
             self.queue = None
 
+    def _readAhead(self, cur):
+        last, self._last = self._last, None
+        if not self.read_ahead or last is None:
+            return
+        limit, offset, fetched = last
+        if fetched < limit:
+            # Already reached the end of the result
+            return
+        offset += limit
+        if self.offset != offset:
+            cur.scroll(offset, 'absolute')
+        data = cur.fetchmany(limit)
+        self.offset = offset + len(data)
+        self._ahead = limit, offset, data
+
     def fetch(self, limit, offset):
         result = AsyncResult()
         self.queue.put((result, limit, offset))
@@ -79,7 +298,10 @@ class ReusableCursor(Greenlet):
         result.get()
 
     def addListener(self, listener):
-        self.listeners.append(listener)
+        self.listeners.add(listener)
+
+    def removeListener(self, listener):
+        self.listeners.discard(listener)
 
     def __hash__(self):
         return hash(self.key)
@@ -118,16 +340,25 @@ class CursorPool(Pool):
                 to_close, _time = g, g.last_access
         if self.full() and to_close is not None:
             logging.debug('Killing idle cursor in %s', self.__class__.__name__)
-            to_close.close()
+            self._evict(to_close)
         ret = self.spawn(db_pool, key, sql, values)
         ret.addListener(self)
         return ret
 
     def onIdle(self, cursor):
         if self._semaphore.waiting:
-            cursor.close()
+            self._evict(cursor)
+
+    def _evict(self, cursor):
+        cursor.close()
 
 
 class SubCursorPool(CursorPool):
     def __init__(self, parent, size=1):
         super(SubCursorPool, self).__init__(size, parent.getCursor)
+
+    def _evict(self, cursor):
+        # Cursors are shared between sessions, only the parent closes them
+        if cursor in self:
+            self.discard(cursor)
+        cursor.removeListener(self)
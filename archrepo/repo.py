@@ -1,26 +1,57 @@
 import abc
 import gevent
+import itertools
 import logging
 import os
 import pwd
 import sys
 import time
 import ujson
-from collections import defaultdict
+import signal
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from distutils.version import LooseVersion
 from gevent import subprocess
 from gevent.event import AsyncResult
-from gevent.lock import RLock
 from gevent.lock import Semaphore
+from gevent.pool import Group, Pool
+from psycopg2 import extensions
 from gevent_zeromq import zmq
 from pyinotify import Event, ProcessEvent
 
 from archrepo import config
-from archrepo.utils import getZmqContext
+from archrepo.changes import notify, PACKAGES
+from archrepo.monitor import SamplingProfiler
+from archrepo.pkginfo import isPackageFile
+from archrepo.query import escapeLike
+from archrepo.schema import adjustOwnerCount, copyRows, dependRows
+from archrepo.schema import rebuildLatest, refreshLatest, updateDepends
+from archrepo.trace import Tracer, newTraceId
+from archrepo.utils import LockTable, getZmqContext
+from archrepo.verify import Verifier, VerifyCancelled
 
 
 arches = ('i686', 'x86_64')
+IGNORED_MOVE_TTL = 60
+RPC_CALLS = ('rescan', 'memoryReport', 'traces', 'profile')
+RPC_FLUSH_ITEMS = 100
+RPC_FLUSH_INTERVAL = 0.5
+REPO_ADD_CHUNK = 1000
+# Arbitrary key of the advisory lock held by the active processor
+PROCESSOR_LOCK = 0x61726371
+PACKAGE_FIELDS = (
+    'description', 'url', 'pkg_group', 'license', 'packager', 'base_name',
+    'build_date', 'size', 'depends', 'uploader', 'owner', 'opt_depends',
+    'enabled', 'file_path', 'last_update')
+
+
+class ManagementError(Exception):
+    pass
+
+
+class StandbyError(Exception):
+    pass
 
 
 def to_list(obj):
@@ -104,15 +135,58 @@ class OwnerFinderForMe(OwnerFinder):
             return self.uid
 
 
+class OwnerFinderInMemory(OwnerFinder):
+    def __init__(self, cursor):
+        self.users = defaultdict(list)
+        cursor.execute('SELECT id, username, realname, email FROM users')
+        for uid, username, realname, email in cursor.fetchall():
+            for name in set([username, realname]):
+                if name:
+                    self.users[name.lower()].append(
+                        (uid, email and email.lower()))
+        self.aliases = {}
+        cursor.execute('SELECT user_id, alias FROM user_aliases')
+        for uid, alias in cursor.fetchall():
+            self.aliases.setdefault(alias.lower(), uid)
+
+    def fromUsers(self, name, email=None):
+        for uid, _email in self.users.get(name, ()):
+            if email is None or email == _email:
+                return uid
+
+    def fromAliases(self, alias):
+        return self.aliases.get(alias)
+
+
 class Processor(ProcessEvent):
     def my_init(self, **kwargs):
         self._started_event = AsyncResult()
-        self._repo_lock = defaultdict(RLock)
-        self._same_pkg_locks = defaultdict(RLock)
-        self._ignored_move_events = set()
-        self._move_events = {}
+        self._repo_lock = LockTable()
+        self._same_pkg_locks = LockTable()
+        # Moves done by auto-rename, expected back from inotify soon
+        self._ignored_move_events = OrderedDict()
+        # Unpaired halves of moves by cookie, oldest first
+        self._move_events = OrderedDict()
+        self._move_timeout = config.xgetint('repository', 'move-timeout', 1)
+        self._move_sweeper = None
+        self._pending_moves = []
+        self._move_applier = None
+        self._rescan_paths = set()
+        self._rescanner = None
+        self._drift_checker = None
+        self._rescan_interval = config.xgetint('repository', 'rescan-interval',
+                                               3600)
 
         self._pool = kwargs.get('pool')
+        # Competes with other processors for the lock before serving
+        self._standby = kwargs.get('standby', False)
+        self._leader_interval = config.xgetint('repository',
+                                               'standby-interval', 5)
+        # Backend of the session holding the lock, while active
+        self._leader_pid = None
+        self._jobs = Group()
+        self.tracer = Tracer()
+        self._profiler = SamplingProfiler()
 
         self._repo_dir = config.get('repository', 'path')
         self._db_name = config.get('repository', 'name') + '.db.tar.gz'
@@ -127,20 +201,32 @@ class Processor(ProcessEvent):
         self._command_pkginfo = os.path.join(
             os.environ.get('ARCHREPO_PREFIX', sys.prefix), 'bin',
             'read_pkginfo.py')
-        self._semaphore = Semaphore(
-            config.xgetint('repository', 'concurrent-jobs', default=256))
+        self._jobs_limit = config.xgetint('repository', 'concurrent-jobs',
+                                          default=256)
+        self._semaphore = Semaphore(self._jobs_limit)
+        self._rpc_concurrency = config.xgetint('repository', 'rpc-concurrency',
+                                               default=8)
+        self._rpc_send_lock = Semaphore()
+        self._rpc_server = None
+        self._verifier = Verifier(
+            (sys.executable, self._command_pkginfo, '--serve'))
 
-    def _repoAddInternal(self, arch, pathname):
-        with self._repo_lock[arch]:
-            subprocess.check_call(
-                (self._command_add,
-                 os.path.join(self._repo_dir, arch, self._db_name), pathname))
+    def _repoAddInternal(self, arch, *pathnames):
+        with self.tracer.acquire('repo-lock', self._repo_lock[arch]):
+            self._checkLeader()
+            with self.tracer.span('repo-add', arch=arch):
+                subprocess.check_call(
+                    (self._command_add,
+                     os.path.join(self._repo_dir, arch, self._db_name)) +
+                    pathnames)
 
     def _repoRemoveInternal(self, arch, name):
-        with self._repo_lock[arch]:
-            subprocess.check_call(
-                (self._command_remove,
-                 os.path.join(self._repo_dir, arch, self._db_name), name))
+        with self.tracer.acquire('repo-lock', self._repo_lock[arch]):
+            self._checkLeader()
+            with self.tracer.span('repo-remove', arch=arch):
+                subprocess.check_call(
+                    (self._command_remove,
+                     os.path.join(self._repo_dir, arch, self._db_name), name))
 
     def _repoRemove(self, arch, name):
         if arch == 'any':
@@ -149,26 +235,29 @@ class Processor(ProcessEvent):
         else:
             self._repoRemoveInternal(arch, name)
 
-    def _repoAdd(self, arch, pathname):
+    def _repoAdd(self, arch, *pathnames):
         if arch == 'any':
             for _arch in arches:
                 _target_dir = os.path.join(self._repo_dir, _arch)
-                _target_link = os.path.join(_target_dir,
-                                            os.path.basename(pathname))
-                _link = True
-                if os.path.exists(_target_link):
-                    if os.path.samefile(pathname, _target_link):
-                        _link = False
-                    else:
+                _target_links = []
+                for pathname in pathnames:
+                    _target_link = os.path.join(_target_dir,
+                                                os.path.basename(pathname))
+                    _link = True
+                    if os.path.exists(_target_link):
+                        if os.path.samefile(pathname, _target_link):
+                            _link = False
+                        else:
+                            os.unlink(_target_link)
+                    elif os.path.lexists(_target_link):
                         os.unlink(_target_link)
-                elif os.path.lexists(_target_link):
-                    os.unlink(_target_link)
-                if _link:
-                    os.symlink(os.path.relpath(pathname, _target_dir),
-                               _target_link)
-                self._repoAddInternal(_arch, _target_link)
+                    if _link:
+                        os.symlink(os.path.relpath(pathname, _target_dir),
+                                   _target_link)
+                    _target_links.append(_target_link)
+                self._repoAddInternal(_arch, *_target_links)
         else:
-            self._repoAddInternal(arch, pathname)
+            self._repoAddInternal(arch, *pathnames)
 
     def _unlinkForAny(self, arch, pathname):
         if arch == 'any':
@@ -194,14 +283,17 @@ class Processor(ProcessEvent):
                 'UPDATE packages SET latest=true '
                  'WHERE id=%s RETURNING file_path', (latest_id,))
             pathname, = cur.fetchone()
+            refreshLatest(cur, name, arch)
             if os.path.exists(pathname):
                 self._repoAdd(arch, pathname)
             else:
                 logging.warning('detected missing file: ' + pathname)
                 self._unlinkForAny(arch, pathname)
                 self._repoRemove(arch, name)
-                gevent.spawn(self._delete, pathname)
+                self._jobs.spawn(self._handleTraced, self.tracer.current(),
+                                 self._delete, pathname)
         else:
+            refreshLatest(cur, name, arch)
             self._repoRemove(arch, name)
 
     def _checkLatest(self, cur, name, arch, pathname, pid, version):
@@ -227,35 +319,36 @@ class Processor(ProcessEvent):
             cur.execute(
                 'UPDATE packages SET latest=true '
                  'WHERE id=%s', (pid,))
+            refreshLatest(cur, name, arch)
             self._repoAdd(arch, pathname)
 
-    def _complete(self, pathname):
+    def _complete(self, pathname, strict=False):
+        # Strict callers get told why nothing was done, as a ManagementError
         if pathname.rstrip('.lck').endswith('.db.tar.gz'):
+            if strict:
+                raise ManagementError('Not a package: ' + pathname)
             return
 
         if os.path.islink(pathname):
+            if strict:
+                raise ManagementError('Symbolic link: ' + pathname)
             return
 
-        if not subprocess.call((self._command_fuser, '-s', pathname),
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+        self.tracer.annotate(path=pathname)
+        with self.tracer.span('fuser'):
+            uploading = not subprocess.call(
+                (self._command_fuser, '-s', pathname),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if uploading:
             logging.info('Uploading ' + pathname)
+            if strict:
+                raise ManagementError('Still uploading: ' + pathname)
             return
 
-        partial = False
-        args = (sys.executable, self._command_pkginfo, pathname)
-        if self._verify:
-            args += ('-v',)
-        info_p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-        out, err = info_p.communicate()
-        if info_p.returncode:
-            if info_p.returncode == 2:
-                partial = True
-            else:
-                logging.info('Ignoring, ' + err.strip())
-                return
-
-        info = ujson.loads(out)
+        result = self._readPackage(pathname, strict)
+        if result is None:
+            return
+        pathname, info, partial = result
 
         name = info[u'pkgname']
         version = info[u'pkgver']
@@ -265,18 +358,10 @@ class Processor(ProcessEvent):
         uploader = pwd.getpwuid(os.stat(pathname).st_uid)[0]
         mtime = datetime.utcfromtimestamp(os.path.getmtime(pathname))
 
-        if self._auto_rename and not partial:
-            dest_dir = os.path.join(self._repo_dir, arch)
-            if not os.path.isdir(dest_dir):
-                os.mkdir(dest_dir)
-            dest_path = os.path.join(dest_dir, '%s-%s-%s.pkg.tar.%s' % (
-                name, version, arch, pathname.rsplit('.', 1)[-1]))
-            if pathname != dest_path:
-                self._ignored_move_events.add((pathname, dest_path))
-                os.rename(pathname, dest_path)
-                pathname = dest_path
-
-        with self._same_pkg_locks[(name, arch)], self._pool.cursor() as cur:
+        self.tracer.annotate(path=pathname, name=name)
+        with self.tracer.acquire('package-lock',
+                                 self._same_pkg_locks[(name, arch)]), \
+                self.tracer.span('db'), self._writeCursor() as cur:
             owner = OwnerFinderInAll(cur)(packager, uploader)
 
             cur.execute(
@@ -284,17 +369,11 @@ class Processor(ProcessEvent):
                  'WHERE name=%s AND arch=%s AND version=%s',
                 (name, arch, version))
             result = cur.fetchone()
-            fields = (
-                'description', 'url', 'pkg_group', 'license', 'packager',
-                'base_name', 'build_date', 'size', 'depends', 'uploader',
-                'owner', 'opt_depends', 'enabled', 'file_path', 'last_update')
-            values = (
-                info.get(u'pkgdesc'), info.get(u'url'), info.get(u'group'),
-                info.get(u'license'), packager, info.get(u'pkgbase', name),
-                int(info.get(u'builddate', time.time())), info.get(u'size'),
-                to_list(info.get(u'depend', [])), uploader, owner,
-                to_list(info.get(u'optdepend', [])), not partial, pathname,
-                mtime)
+            depends = to_list(info.get(u'depend', []))
+            opt_depends = to_list(info.get(u'optdepend', []))
+            fields = PACKAGE_FIELDS
+            values = self._packageValues(info, pathname, partial, uploader,
+                                         owner, mtime)
             if not result:
                 logging.info('Adding new file %s(%s)', name, arch)
                 cur.execute(
@@ -304,6 +383,8 @@ class Processor(ProcessEvent):
                     (name, arch, version) + values)
                 pid, = cur.fetchone()
                 logging.debug('Inserted with id %s', pid)
+                if not partial:
+                    updateDepends(cur, pid, depends, opt_depends)
 
                 if not partial:
                     self._checkLatest(cur, name, arch, pathname, pid, version)
@@ -317,24 +398,175 @@ class Processor(ProcessEvent):
                     'UPDATE packages SET %s WHERE id=%%s' % (
                         ', '.join([x + '=%s' for x in fields]),),
                     values + (pid,))
+                if partial:
+                    updateDepends(cur, pid, (), ())
+                else:
+                    updateDepends(cur, pid, depends, opt_depends)
                 if latest and partial:
                     self._removeLatest(cur, name, arch)
+                elif latest:
+                    refreshLatest(cur, name, arch)
                 if not enabled and not partial:
                     self._checkLatest(cur, name, arch, pathname, pid, version)
 
+    def _packageValues(self, info, pathname, partial, uploader, owner, mtime):
+        return (
+            info.get(u'pkgdesc'), info.get(u'url'), info.get(u'group'),
+            info.get(u'license'), info.get(u'packager'),
+            info.get(u'pkgbase', info[u'pkgname']),
+            int(info.get(u'builddate', time.time())), info.get(u'size'),
+            to_list(info.get(u'depend', [])), uploader, owner,
+            to_list(info.get(u'optdepend', [])), not partial, pathname, mtime)
+
+    def _readPackage(self, pathname, strict=False):
+        # Verified .PKGINFO of the file, at its path after auto-rename
+        partial = False
+        try:
+            with self.tracer.span('read-pkginfo', verify=self._verify):
+                code, out, err = self._verifier.verify(pathname, self._verify)
+        except VerifyCancelled:
+            if strict:
+                raise ManagementError('Moved or deleted while verifying: ' +
+                                      pathname)
+            return
+        except OSError:
+            logging.info('Ignoring, %s is gone', pathname)
+            if strict:
+                raise ManagementError('No such file: ' + pathname)
+            return
+        if code:
+            if code == 2:
+                partial = True
+            else:
+                logging.info('Ignoring, ' + err.strip())
+                if strict:
+                    raise ManagementError(err.strip())
+                return
+
+        info = ujson.loads(out)
+
+        name = info[u'pkgname']
+        version = info[u'pkgver']
+        arch = info[u'arch']
+
+        if self._auto_rename and not partial:
+            dest_dir = os.path.join(self._repo_dir, arch)
+            if not os.path.isdir(dest_dir):
+                os.mkdir(dest_dir)
+            dest_path = os.path.join(dest_dir, '%s-%s-%s.pkg.tar.%s' % (
+                name, version, arch, pathname.rsplit('.', 1)[-1]))
+            if pathname != dest_path:
+                self._ignoreMove(pathname, dest_path)
+                os.rename(pathname, dest_path)
+                pathname = dest_path
+        return pathname, info, partial
+
+    def importAll(self, pathnames):
+        # Bootstrapping many packages at once: read them on all verify
+        # workers, COPY the rows in one transaction and run repo-add once
+        # per arch, instead of going through _complete one by one
+        read = []
+        jobs = Pool(self._verifier.workers * 2)
+        for result in jobs.imap_unordered(self._readPackage, pathnames):
+            if result is not None:
+                read.append(result)
+        logging.info('Read %d of %d packages', len(read), len(pathnames))
+
+        with self._pool.cursor() as cur:
+            find_owner = OwnerFinderInMemory(cur)
+            known = set()
+            candidates = defaultdict(list)
+            cur.execute('SELECT id, name, arch, version, enabled, latest '
+                          'FROM packages')
+            for pid, name, arch, version, enabled, latest in cur.fetchall():
+                known.add((name, arch, version))
+                if enabled:
+                    candidates[(name, arch)].append(
+                        (LooseVersion(version), latest, pid))
+
+            cur.execute("SELECT nextval('packages_id_seq') "
+                          "FROM generate_series(1, %s)", (len(read),))
+            rows = []
+            depends = []
+            paths = {}
+            for (pathname, info, partial), (pid,) in zip(read,
+                                                         cur.fetchall()):
+                name = info[u'pkgname']
+                version = info[u'pkgver']
+                arch = info[u'arch']
+                if (name, arch, version) in known:
+                    logging.info('Skipping %s, %s(%s) %s is known', pathname,
+                                 name, arch, version)
+                    continue
+                known.add((name, arch, version))
+                uploader = pwd.getpwuid(os.stat(pathname).st_uid)[0]
+                mtime = datetime.utcfromtimestamp(os.path.getmtime(pathname))
+                owner = find_owner(info.get(u'packager'), uploader)
+                values = self._packageValues(info, pathname, partial,
+                                             uploader, owner, mtime)
+                rows.append([pid, name, arch, version] + list(values))
+                paths[pid] = (arch, pathname)
+                if not partial:
+                    candidates[(name, arch)].append(
+                        (LooseVersion(version), False, pid))
+                    depends.extend(dependRows(
+                        pid, to_list(info.get(u'depend', [])),
+                        to_list(info.get(u'optdepend', []))))
+
+            # The highest version of every (name, arch) is the latest one
+            latest = set()
+            flipped = []
+            for group in candidates.itervalues():
+                best = max(group)[2]
+                latest.add(best)
+                flipped.extend([pid for _, was_latest, pid in group
+                                if was_latest != (pid == best)])
+            for row in rows:
+                row.append(row[0] in latest)
+
+            logging.info('Copying %d packages', len(rows))
+            copyRows(cur, 'packages',
+                     ('id', 'name', 'arch', 'version') + PACKAGE_FIELDS +
+                     ('latest',), rows)
+            copyRows(cur, 'package_depends',
+                     ('package_id', 'dep_name', 'dep_op', 'dep_version',
+                      'optional'), depends)
+            cur.execute('UPDATE packages SET latest=NOT latest '
+                         'WHERE id=ANY(%s)',
+                        ([x for x in flipped if x not in paths],))
+            rebuildLatest(cur)
+
+        added = defaultdict(list)
+        for pid, (arch, pathname) in paths.iteritems():
+            if pid in latest:
+                added[arch].append(pathname)
+        for arch, paths in added.iteritems():
+            logging.info('Adding %d packages to the %s repo', len(paths), arch)
+            for i in xrange(0, len(paths), REPO_ADD_CHUNK):
+                self._repoAdd(arch, *paths[i:i + REPO_ADD_CHUNK])
+        return len(rows)
+
     def _new(self, pathname):
         pass
 
-    def _delete(self, pathname):
-        if pathname.endswith('.pkg.tar.gz') or pathname.endswith('.pkg.tar.xz'):
-            with self._pool.cursor() as cur:
+    def _delete(self, pathname, strict=False):
+        self._verifier.cancel(pathname)
+        self.tracer.annotate(path=pathname)
+        if strict and not isPackageFile(pathname):
+            raise ManagementError('Not a package: ' + pathname)
+        if isPackageFile(pathname):
+            with self.tracer.span('db'), self._writeCursor() as cur:
                 cur.execute(
                     'SELECT id, arch, name, latest FROM packages '
                      'WHERE file_path=%s', (pathname,))
                 result = cur.fetchone()
+                if not result and strict:
+                    raise ManagementError('Unknown package: ' + pathname)
                 if result:
                     id_, arch, name, latest = result
-                    with self._same_pkg_locks[(name, arch)]:
+                    self.tracer.annotate(name=name)
+                    lock = self._same_pkg_locks[(name, arch)]
+                    with self.tracer.acquire('package-lock', lock):
                         logging.info('Removing file record %s', pathname)
                         cur.execute(
                             'UPDATE packages '
@@ -342,25 +574,247 @@ class Processor(ProcessEvent):
                                    'enabled=false, '
                                    'latest=false '
                              'WHERE id=%s', ('', id_,))
+                        updateDepends(cur, id_, (), ())
                         if latest:
                             self._removeLatest(cur, name, arch)
                     self._unlinkForAny(arch, pathname)
 
-    def _move(self, src, dest):
-        if (src, dest) in self._ignored_move_events:
-            self._ignored_move_events.remove((src, dest))
-        elif src.endswith('.pkg.tar.gz') or src.endswith('.pkg.tar.xz'):
-            with self._pool.cursor() as cur:
+    def _ignoreMove(self, src, dest):
+        now = time.time()
+        events = self._ignored_move_events
+        # Never reported if the watcher was down, forget them eventually
+        while events and next(events.itervalues()) < now:
+            events.popitem(last=False)
+        events.pop((src, dest), None)
+        events[(src, dest)] = now + IGNORED_MOVE_TTL
+
+    def _move(self, src, dest, is_dir=False, done=None):
+        # done, an AsyncResult, gets the error or None once applied
+        if self._ignored_move_events.pop((src, dest), 0) >= time.time():
+            if done is not None:
+                done.set(None)
+            return
+        if is_dir:
+            moved = self._verifier.cancelUnder(src)
+        elif self._verifier.cancel(src):
+            moved = [src]
+        else:
+            moved = []
+        for path in moved:
+            # Moved while being verified, start over at the new path
+            self._jobs.spawn(self._handleTraced, self.tracer.current(),
+                             self._complete, dest + path[len(src):])
+        if is_dir or isPackageFile(src):
+            self._pending_moves.append((src, dest, is_dir, done))
+            if self._move_applier is None:
+                # Everything paired before it runs goes in one transaction
+                self._move_applier = self._jobs.spawn(self._applyMoves)
+        elif done is not None:
+            done.set('Not a package: ' + src)
+
+    def _applyMoves(self):
+        try:
+            while self._pending_moves:
+                moves, self._pending_moves = self._pending_moves, []
+                try:
+                    unknown = self._updateMovedPaths(moves)
+                except Exception as e:
+                    logging.error('Failed updating moved paths',
+                                  exc_info=True)
+                    errors = dict((x, str(e)) for x in moves)
+                else:
+                    errors = dict((x, 'Unknown package: ' + x[0])
+                                  for x in unknown)
+                for move in moves:
+                    if move[3] is not None:
+                        move[3].set(errors.get(move))
+        finally:
+            self._move_applier = None
+
+    def _updateMovedPaths(self, moves):
+        # One transaction, returns the file moves matching no package
+        unknown = []
+        with self._writeCursor() as cur:
+            files = []
+            for move in moves:
+                src, dest, is_dir, done = move
+                if not is_dir:
+                    files.append(move)
+                    continue
+                logging.info('Updating paths due to mv %s to %s', src, dest)
+                src = src.rstrip('/') + '/'
                 cur.execute(
-                    'SELECT id FROM packages WHERE file_path=%s', (src,))
-                result = cur.fetchone()
-                if result:
-                    logging.info('Updating path due to mv %s to %s', src, dest)
-                    cur.execute('UPDATE packages SET file_path=%s WHERE id=%s',
-                        (result[0],))
+                    'UPDATE packages '
+                       'SET file_path=%s || substr(file_path, %s) '
+                     'WHERE file_path LIKE %s',
+                    (dest.rstrip('/') + '/', len(src) + 1,
+                     escapeLike(src) + '%'))
+            for i in xrange(0, len(files), 1000):
+                chunk = files[i:i + 1000]
+                logging.info('Updating %d paths due to mv', len(chunk))
+                cur.execute(
+                    'UPDATE packages SET file_path=moves.dest '
+                      'FROM (VALUES %s) AS moves (src, dest) '
+                     'WHERE file_path=moves.src '
+                    'RETURNING moves.src' % ', '.join(
+                        [cur.mogrify('(%s, %s)', x[:2]) for x in chunk]))
+                updated = set(x[0].encode('utf-8') for x in cur.fetchall())
+                unknown.extend(x for x in chunk if x[0] not in updated)
+        return unknown
+
+    def _addMoveEvent(self, cookie, kind, pathname, is_dir):
+        self._move_events[cookie] = (kind, pathname, is_dir,
+                                     time.time() + self._move_timeout,
+                                     self.tracer.current())
+        if self._move_sweeper is None:
+            self._move_sweeper = self._jobs.spawn(self._sweepMoveEvents)
+
+    def _sweepMoveEvents(self):
+        # A single timer for all unpaired moves, they expire in order
+        try:
+            while self._move_events:
+                cookie, (kind, pathname, is_dir, expires, trace) = \
+                    next(self._move_events.iteritems())
+                delay = expires - time.time()
+                if delay > 0:
+                    gevent.sleep(delay)
+                    continue
+                del self._move_events[cookie]
+                if kind == 'from':
+                    # Moved out of the repository
+                    func = self._deleteDir if is_dir else self._delete
+                else:
+                    # Moved into the repository
+                    func = self._completeDir if is_dir else self._complete
+                self._jobs.spawn(self._handleTraced, trace, func, pathname)
+        finally:
+            self._move_sweeper = None
+
+    def _deleteDir(self, pathname):
+        prefix = pathname.rstrip('/') + '/'
+        with self._pool.cursor() as cur:
+            cur.execute('SELECT file_path FROM packages '
+                         'WHERE file_path LIKE %s',
+                        (escapeLike(prefix) + '%',))
+            paths = [x[0] for x in cur.fetchall()]
+        for path in paths:
+            self._delete(path)
+
+    def _completeDir(self, pathname):
+        for dirpath, dirnames, filenames in os.walk(pathname):
+            for name in filenames:
+                if isPackageFile(name):
+                    self._complete(os.path.join(dirpath, name))
+
+    def rescan(self, pathname=None):
+        self._rescan_paths.add(pathname or self._repo_dir)
+        if self._rescanner is None:
+            self._rescanner = gevent.spawn(self._rescanAll)
+
+    def _rescanAll(self):
+        try:
+            while self._rescan_paths:
+                pathname = self._rescan_paths.pop()
+                try:
+                    self._rescan(pathname)
+                except Exception:
+                    logging.error('Failed rescanning %s', pathname,
+                                  exc_info=True)
+        finally:
+            self._rescanner = None
+
+    def _rescan(self, top):
+        # Every directory is listed, but only those changed since the last
+        # scan are compared with the database, entries added, removed or
+        # renamed in a directory all update its mtime
+        top = top.rstrip('/')
+        prefix = top + '/'
+        with self._pool.cursor() as cur:
+            cur.execute('SELECT path, mtime FROM scanned_dirs '
+                         'WHERE path=%s OR path LIKE %s',
+                        (top, escapeLike(prefix) + '%'))
+            scanned = dict((x[0].encode('utf-8'), x[1])
+                           for x in cur.fetchall())
+        logging.info('Rescanning %s', top)
+        changed = 0
+        errors = []
+        for dirpath, dirnames, filenames in os.walk(top,
+                                                    onerror=errors.append):
+            try:
+                mtime = int(os.stat(dirpath).st_mtime * 1e9)
+            except OSError as e:
+                errors.append(e)
+                continue
+            if scanned.pop(dirpath, None) != mtime:
+                self._rescanDir(dirpath, filenames, mtime)
+                changed += 1
+            # Low priority, lets events and requests go first
+            gevent.sleep(0)
+        if errors:
+            # Unreadable is not gone, keep everything not walked for now
+            for e in errors:
+                logging.warning('Rescan of %s failed on %s: %s', top,
+                                e.filename, e.strerror)
+            logging.info('Rescanned %s, %d directories changed, not '
+                         'removing any after errors', top, changed)
+            return
+        # Directories gone without us noticing
+        removed = 0
+        for dirpath in scanned:
+            if os.path.lexists(dirpath):
+                continue
+            self._deleteDir(dirpath)
+            with self._writeCursor() as cur:
+                cur.execute('DELETE FROM scanned_dirs WHERE path=%s',
+                            (dirpath,))
+            removed += 1
+        logging.info('Rescanned %s, %d directories changed, %d removed',
+                     top, changed, removed)
+
+    def _rescanDir(self, dirpath, filenames, mtime):
+        files = set()
+        for name in filenames:
+            if isPackageFile(name):
+                path = os.path.join(dirpath, name)
+                if not os.path.islink(path):
+                    files.add(path)
+        prefix = dirpath + '/'
+        with self._pool.cursor() as cur:
+            # Files right in the directory, not in its subdirectories
+            cur.execute('SELECT file_path FROM packages '
+                         'WHERE file_path LIKE %s AND file_path NOT LIKE %s',
+                        (escapeLike(prefix) + '%', escapeLike(prefix) + '%/%'))
+            known = set(x[0].encode('utf-8') for x in cur.fetchall())
+        failed = 0
+        for func, paths, action in (
+                (self._complete, files.difference(known), 'Adding'),
+                (self._delete, known.difference(files), 'Deleting')):
+            for path in paths:
+                logging.info('%s %s by rescan', action, path)
+                try:
+                    with self.tracer.activate(self.tracer.start(path=path)):
+                        func(path)
+                except Exception:
+                    logging.error('Failed rescanning %s', path, exc_info=True)
+                    failed += 1
+        if failed:
+            # Not recorded as scanned, the next rescan tries them again
+            return
+        with self._writeCursor() as cur:
+            cur.execute('UPDATE scanned_dirs SET mtime=%s WHERE path=%s',
+                        (mtime, dirpath))
+            if not cur.rowcount:
+                cur.execute('INSERT INTO scanned_dirs (path, mtime) '
+                            'VALUES (%s, %s)', (dirpath, mtime))
+
+    def _checkDrift(self):
+        while True:
+            gevent.sleep(self._rescan_interval)
+            self.rescan()
 
     def _modify(self, pathname):
-        pass
+        # Being written again, the coming IN_CLOSE_WRITE verifies it
+        self._verifier.cancel(pathname)
     #        info_p = subprocess.Popen((sys.executable,
     #                                   os.path.join(
     #               os.environ.get('ARCHREPO_PREFIX', sys.prefix), 'bin',
@@ -371,7 +825,7 @@ class Processor(ProcessEvent):
     #        print os.stat(pathname).st_size * 100 / full, '%'
 
     def _autoAdopt(self, uid):
-        with self._pool.cursor() as cur:
+        with self._writeCursor() as cur:
             cur.execute('SELECT username, realname, email FROM users '
                          'WHERE id=%s', (uid,))
             result = cur.fetchone()
@@ -390,6 +844,11 @@ class Processor(ProcessEvent):
                 if owner is not None:
                     cur.execute('UPDATE packages SET owner=%s WHERE id=%s',
                                 (owner, pid))
+                    cur.execute('UPDATE latest_packages SET owner=%s '
+                                 'WHERE id=%s', (owner, pid))
+                    if cur.rowcount:
+                        adjustOwnerCount(cur, owner, 1)
+                        notify(cur, PACKAGES)
 
     def process_IN_MODIFY(self, event):
         if not event.dir:
@@ -400,26 +859,24 @@ class Processor(ProcessEvent):
             self._complete(event.pathname)
 
     def process_IN_MOVED_FROM(self, event):
-        if not event.dir and event.cookie is not None:
-            if event.cookie in self._move_events:
-                g = self._move_events[event.cookie]
-                assert g._run == self._complete
-                self._move(event.pathname, g.args[0])
-                g.kill()
+        if event.cookie is not None:
+            move = self._move_events.get(event.cookie)
+            if move is not None and move[0] == 'to':
+                del self._move_events[event.cookie]
+                self._move(event.pathname, move[1], event.dir)
             else:
-                self._move_events[event.cookie] = gevent.spawn_later(
-                    1, self._delete, event.pathname)
+                self._addMoveEvent(event.cookie, 'from', event.pathname,
+                                   event.dir)
 
     def process_IN_MOVED_TO(self, event):
-        if not event.dir and event.cookie is not None:
-            if event.cookie in self._move_events:
-                g = self._move_events[event.cookie]
-                assert g._run == self._delete
-                self._move(g.args[0], event.pathname)
-                g.kill()
+        if event.cookie is not None:
+            move = self._move_events.get(event.cookie)
+            if move is not None and move[0] == 'from':
+                del self._move_events[event.cookie]
+                self._move(move[1], event.pathname, event.dir)
             else:
-                self._move_events[event.cookie] = gevent.spawn_later(
-                    1, self._complete, event.pathname)
+                self._addMoveEvent(event.cookie, 'to', event.pathname,
+                                   event.dir)
 
     def process_IN_CREATE(self, event):
         if not event.dir:
@@ -433,19 +890,137 @@ class Processor(ProcessEvent):
         logging.debug('Not handled %s %s', event.maskname, event.pathname)
 
     def serve(self):
-        self._greenlet = gevent.spawn(self._serve)
+        gevent.signal(signal.SIGUSR1, self.logMemoryReport)
+        if self._standby:
+            # Up whether active or not, the web server does not wait for it
+            self._started_event.set(True)
+            self._greenlet = gevent.spawn(self._lead)
+        else:
+            self._greenlet = gevent.spawn(self._serve)
 
     def kill(self):
         self._greenlet.kill()
+        self._stopServing()
+        self._verifier.kill()
+
+    def _stopServing(self):
+        if self._drift_checker is not None:
+            self._drift_checker.kill()
+        if self._rescanner is not None:
+            self._rescanner.kill()
+        if self._rpc_server is not None:
+            self._rpc_server.kill()
+        if self._move_applier is not None:
+            self._move_applier.kill()
+        if self._move_sweeper is not None:
+            self._move_sweeper.kill()
+
+    def _lead(self):
+        autocommit = extensions.ISOLATION_LEVEL_AUTOCOMMIT
+        while True:
+            try:
+                with self._pool.connection(isolation_level=autocommit) as conn:
+                    self._leadWith(conn)
+            except Exception:
+                logging.error('Lost the processor lock', exc_info=True)
+            gevent.sleep(self._leader_interval)
+
+    def _leadWith(self, conn):
+        cur = conn.cursor()
+        logging.info('Standing by for the processor lock')
+        while True:
+            cur.execute('SELECT pg_try_advisory_lock(%s)', (PROCESSOR_LOCK,))
+            if cur.fetchone()[0]:
+                break
+            gevent.sleep(self._leader_interval)
+        cur.execute('SELECT pg_backend_pid()')
+        self._leader_pid = cur.fetchone()[0]
+        logging.info('Became the active processor')
+        server = gevent.spawn(self._serve)
+        try:
+            # Events while no processor was active are only partly queued
+            # by the inotify monitor, catch up on the rest
+            self.rescan()
+            while not server.ready():
+                gevent.sleep(self._leader_interval)
+                cur.execute('SELECT 1')
+        finally:
+            # Stop writing before anybody else may take over
+            self._leader_pid = None
+            server.kill()
+            self._jobs.kill()
+            self._stopServing()
+            logging.info('Stopped being the active processor')
+            try:
+                cur.execute('SELECT pg_advisory_unlock(%s)',
+                            (PROCESSOR_LOCK,))
+            except Exception:
+                # Gone with the connection anyway
+                pass
+
+    def _checkLeader(self, cur=None):
+        # Without standby nothing is fenced, only one server may process
+        # a repository then
+        if not self._standby:
+            return
+        if cur is None:
+            with self._pool.cursor() as cur:
+                return self._checkLeader(cur)
+        pid = self._leader_pid
+        if pid is not None:
+            cur.execute('SELECT count(*) FROM pg_locks '
+                         'WHERE locktype=%s AND objid=%s AND pid=%s '
+                           'AND granted', ('advisory', PROCESSOR_LOCK, pid))
+            if cur.fetchone()[0]:
+                return
+        raise StandbyError('Not the active processor')
+
+    @contextmanager
+    def _writeCursor(self):
+        # Checked in every write transaction, right before writing, so a
+        # processor whose lock session is gone stops at the next one
+        with self._pool.cursor() as cur:
+            self._checkLeader(cur)
+            yield cur
+
+    def memoryReport(self):
+        report = {
+            'repo_locks': len(self._repo_lock),
+            'package_locks': len(self._same_pkg_locks),
+            'ignored_move_events': len(self._ignored_move_events),
+            'move_events': len(self._move_events),
+            'pending_moves': len(self._pending_moves),
+            'rescan_paths': len(self._rescan_paths),
+            'running_jobs': self._jobs_limit - self._semaphore.counter,
+        }
+        report.update(('verify_' + k, v)
+                      for k, v in self._verifier.report().iteritems())
+        return report
+
+    def logMemoryReport(self):
+        logging.info('Processor memory report: %s', ', '.join(
+            '%s=%s' % x for x in sorted(self.memoryReport().iteritems())))
+
+    def traces(self, query):
+        return self.tracer.find(query)
+
+    def profile(self, seconds, interval):
+        return self._profiler.profile(seconds, interval)
 
     def _handle_wrapper(self, func, *args):
         try:
-            with self._semaphore:
+            with self.tracer.acquire('wait-jobs', self._semaphore), \
+                    self.tracer.span('handle', method=func.__name__):
                 func(*args)
         except Exception:
             logging.error('Error handling ZMQ message', exc_info=True)
 
+    def _handleTraced(self, trace, func, *args):
+        with self.tracer.activate(trace):
+            self._handle_wrapper(func, *args)
+
     def handle_inotify(self, mask, cookie, _dir, pathname):
+        self.tracer.annotate(path=pathname)
         if cookie == '':
             cookie = None
         else:
@@ -470,14 +1045,132 @@ class Processor(ProcessEvent):
                 self._started_event.set(False)
             else:
                 self._started_event.set(True)
+                if self._rescan_interval > 0:
+                    self._drift_checker = gevent.spawn(self._checkDrift)
+                self._rpc_server = gevent.spawn(self._serveRpc)
                 while True:
                     parts = self.socket.recv_multipart()
+                    trace = None
+                    if parts[0] == 'traced' and len(parts) > 3:
+                        # Trace ID and sending time, then the message
+                        try:
+                            sent = float(parts[2])
+                        except ValueError:
+                            logging.warning('Dropped message with bad trace '
+                                            'header: %r', parts[:3])
+                            continue
+                        trace = self.tracer.start(parts[1], sent=sent)
+                        parts = parts[3:]
                     handler = getattr(self, 'handle_' + parts[0], None)
                     if handler:
-                        gevent.spawn(self._handle_wrapper, handler, *parts[1:])
+                        self._jobs.spawn(self._handleTraced, trace, handler,
+                                         *parts[1:])
         finally:
             self.socket.close()
 
+    def _serveRpc(self):
+        self.rpc_socket = getZmqContext().socket(zmq.ROUTER)
+        try:
+            self.rpc_socket.bind(config.xget(
+                'repository', 'management-rpc-socket',
+                default='tcp://127.0.0.1:6614'))
+            while True:
+                parts = self.rpc_socket.recv_multipart()
+                if len(parts) == 4:
+                    self._jobs.spawn(self._handleRpc, *parts)
+        finally:
+            self.rpc_socket.close()
+
+    def _sendRpc(self, identity, request_id, kind, payload):
+        with self._rpc_send_lock:
+            self.rpc_socket.send_multipart(
+                (identity, request_id, kind, ujson.dumps(payload)))
+
+    def _handleRpc(self, identity, request_id, method, args):
+        try:
+            args = ujson.loads(args)
+            if method == 'complete':
+                result = self._runBulk(identity, request_id,
+                                       self._completeItem,
+                                       [(x.encode('utf-8'),) for x in args])
+            elif method == 'delete':
+                result = self._runBulk(identity, request_id,
+                                       self._deleteItem,
+                                       [(x.encode('utf-8'),) for x in args])
+            elif method == 'move':
+                result = self._runBulk(
+                    identity, request_id, self._moveItem,
+                    [(x.encode('utf-8'), y.encode('utf-8')) for x, y in args])
+            elif method in RPC_CALLS:
+                result = getattr(self, method)(*[
+                    x.encode('utf-8') if isinstance(x, unicode) else x
+                    for x in args])
+            else:
+                raise ManagementError('Unknown method %s' % method)
+        except Exception as e:
+            logging.error('Failed handling management request %s', method,
+                          exc_info=True)
+            self._sendRpc(identity, request_id, 'error', str(e))
+        else:
+            self._sendRpc(identity, request_id, 'done', result)
+
+    def _completeItem(self, pathname):
+        self._complete(pathname, strict=True)
+
+    def _deleteItem(self, pathname):
+        self._delete(pathname, strict=True)
+
+    def _moveItem(self, src, dest):
+        # Reported done once the paths are updated
+        done = AsyncResult()
+        self._move(src, dest, os.path.isdir(dest), done)
+        error = done.get()
+        if error is not None:
+            raise ManagementError(error)
+
+    def _runBulk(self, identity, request_id, func, items):
+        results = []
+        state = {'failed': 0, 'flushed': time.time()}
+
+        def flush():
+            if results:
+                self._sendRpc(identity, request_id, 'items', results[:])
+                del results[:]
+            state['flushed'] = time.time()
+
+        def run(index, args):
+            try:
+                with self.tracer.activate(self.tracer.start(path=args[0])), \
+                        self.tracer.acquire('wait-jobs', self._semaphore), \
+                        self.tracer.span('handle', method=func.__name__):
+                    func(*args)
+            except Exception as e:
+                if isinstance(e, ManagementError):
+                    logging.info('Skipped bulk item %r: %s', args, e)
+                else:
+                    logging.error('Failed bulk item %r', args, exc_info=True)
+                state['failed'] += 1
+                results.append((index, str(e)))
+            else:
+                results.append((index, None))
+            # Progress goes out in batches, not a message per item
+            if (len(results) >= RPC_FLUSH_ITEMS or
+                    time.time() - state['flushed'] >= RPC_FLUSH_INTERVAL):
+                flush()
+
+        # Blocks while the pool is full, so a huge request never becomes
+        # more than rpc-concurrency jobs at a time
+        pool = Pool(self._rpc_concurrency)
+        try:
+            for index, args in enumerate(items):
+                pool.spawn(run, index, args)
+            pool.join()
+        finally:
+            # Killed along with the request when stepping down
+            pool.kill()
+        flush()
+        return {'total': len(items), 'failed': state['failed']}
+
     @property
     def serving(self):
         return self._started_event.get()
@@ -491,5 +1184,52 @@ class FakeProcessor(object):
 
     def __getattr__(self, item):
         def delegate(*args):
-            self.socket.send_multipart(('execute', item) + args)
+            self.socket.send_multipart(
+                ('traced', newTraceId(), '%.6f' % time.time(), 'execute',
+                 item) + args)
         return delegate
+
+
+class ManagementClient(object):
+    def __init__(self):
+        ctx = getZmqContext()
+        self.socket = ctx.socket(zmq.DEALER)
+        # Nothing left to deliver once we gave up on the processor
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(config.xget('repository', 'management-rpc-socket',
+                                        default='tcp://127.0.0.1:6614'))
+        self._request_ids = itertools.count()
+        self._timeout = config.xgetint('repository', 'management-rpc-timeout',
+                                       300)
+
+    def call(self, method, *args):
+        return self._request(method, args)
+
+    def bulk(self, method, items, progress=None):
+        # progress(item, error) is called as results arrive, error is None
+        # for succeeded items
+        return self._request(method, items, progress)
+
+    def _request(self, method, args, progress=None):
+        request_id = str(next(self._request_ids))
+        self.socket.send_multipart((request_id, method, ujson.dumps(args)))
+        while True:
+            reply_id, kind, payload = self._recv()
+            if reply_id != request_id:
+                continue
+            payload = ujson.loads(payload)
+            if kind == 'items':
+                if progress is not None:
+                    for index, error in payload:
+                        progress(args[index], error)
+            elif kind == 'done':
+                return payload
+            else:
+                raise ManagementError(payload)
+
+    def _recv(self):
+        # Any reply, progress included, restarts the wait
+        with gevent.Timeout(self._timeout, False):
+            return self.socket.recv_multipart()
+        raise ManagementError('No reply from the processor in %d seconds' %
+                              self._timeout)
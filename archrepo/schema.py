@@ -1,7 +1,14 @@
+import logging
 import os
 import pwd
+import re
+from StringIO import StringIO
+from collections import defaultdict
+from datetime import datetime
+from psycopg2 import extensions
 
 from archrepo import config
+from archrepo.changes import notify, PACKAGES, USERS
 
 
 schema = {
@@ -58,9 +65,256 @@ CREATE TABLE user_aliases (
 );
 CREATE INDEX alias_by_user ON user_aliases (user_id);
 CREATE INDEX user_by_alias ON user_aliases (alias);
+''',
+    'schema_migrations': '''\
+CREATE TABLE schema_migrations (
+    version     integer PRIMARY KEY,
+    description text,
+    applied_at  timestamp without time zone NOT NULL DEFAULT now()
+);
 ''',
 }
 
+# Columns mirrored from packages into latest_packages
+LATEST_FIELDS = ('id', 'name', 'arch', 'version', 'description',
+                 'last_update', 'flag_date', 'owner', 'searchable',
+                 'base_name')
+
+# Arbitrary key of the advisory lock serializing concurrent migration runs
+MIGRATION_LOCK = 0x61726370
+
+
+def createIndex(name, definition):
+    def migrate(cur):
+        cur.execute('SELECT i.indisvalid FROM pg_class c '
+                     'JOIN pg_index i ON i.indexrelid=c.oid '
+                     'WHERE c.relname=%s', (name,))
+        result = cur.fetchone()
+        if result:
+            if result[0]:
+                return
+            # Leftover of an interrupted CREATE INDEX CONCURRENTLY
+            logging.warning('Dropping invalid index %s', name)
+            cur.execute('DROP INDEX %s' % name)
+        cur.execute('CREATE INDEX CONCURRENTLY %s ON %s' % (name, definition))
+    migrate.online = True
+    return migrate
+
+
+def adjustOwnerCount(cur, owner, delta):
+    if owner is None or not delta:
+        return
+    cur.execute('UPDATE users SET package_count=package_count+%s '
+                 'WHERE id=%s RETURNING package_count', (delta, owner))
+    result = cur.fetchone()
+    if result and 0 in (result[0], result[0] - delta):
+        # Became or stopped being a maintainer
+        notify(cur, USERS)
+
+
+def refreshLatest(cur, name, arch):
+    deltas = defaultdict(int)
+    cur.execute('DELETE FROM latest_packages WHERE name=%s AND arch=%s '
+                 'RETURNING owner', (name, arch))
+    for owner, in cur.fetchall():
+        deltas[owner] -= 1
+    cur.execute('INSERT INTO latest_packages (%s) SELECT %s FROM packages '
+                 'WHERE name=%%s AND arch=%%s AND latest RETURNING owner' % (
+                    ', '.join(LATEST_FIELDS), ', '.join(LATEST_FIELDS)),
+                (name, arch))
+    for owner, in cur.fetchall():
+        deltas[owner] += 1
+    for owner, delta in deltas.iteritems():
+        adjustOwnerCount(cur, owner, delta)
+    notify(cur, PACKAGES)
+
+
+# The version may have an epoch, "1:2.0-1", only ": " starts a description
+_depend = re.compile(
+    r'^\s*([^<>=:\s]+)\s*(?:(<=|>=|<|>|=)\s*((?:[^:\s]|:(?=\S))+))?')
+
+
+def parseDepend(depend):
+    # "name", "name>=1.0-1" or, for optdepends, "name: what it is for"
+    match = _depend.match(depend)
+    if match:
+        return match.groups()
+
+
+def dependRows(pid, depends, opt_depends):
+    rows = []
+    for optional, items in ((False, depends), (True, opt_depends)):
+        for item in items or ():
+            parsed = parseDepend(item)
+            if parsed:
+                rows.append((pid,) + parsed + (optional,))
+    return rows
+
+
+def updateDepends(cur, pid, depends, opt_depends):
+    cur.execute('DELETE FROM package_depends WHERE package_id=%s', (pid,))
+    rows = dependRows(pid, depends, opt_depends)
+    if rows:
+        cur.executemany('INSERT INTO package_depends '
+                         '(package_id, dep_name, dep_op, dep_version, optional) '
+                         'VALUES (%s, %s, %s, %s, %s)', rows)
+    notify(cur, PACKAGES)
+
+
+def _copyText(value):
+    if isinstance(value, bool):
+        return u't' if value else u'f'
+    if isinstance(value, (list, tuple)):
+        # Array literal, elements quoted so that commas and braces are safe
+        items = [_copyText(x).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+                 for x in value]
+        return u'{%s}' % u','.join([u'"%s"' % x for x in items])
+    if isinstance(value, datetime):
+        return value.isoformat().decode('ascii')
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def _copyValue(value):
+    if value is None:
+        return u'\\N'
+    value = _copyText(value).replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+    return value.replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+
+def copyRows(cur, table, columns, rows):
+    buf = StringIO()
+    for row in rows:
+        buf.write(u'\t'.join([_copyValue(x) for x in row]).encode('utf-8'))
+        buf.write('\n')
+    buf.seek(0)
+    # COPY refuses to run with a wait callback, so it blocks the hub
+    callback = extensions.get_wait_callback()
+    extensions.set_wait_callback(None)
+    try:
+        cur.copy_from(buf, table, columns=columns)
+    finally:
+        extensions.set_wait_callback(callback)
+
+
+def _copyLatest(cur, fields=LATEST_FIELDS):
+    cur.execute('INSERT INTO latest_packages (%s) SELECT %s FROM packages '
+                 'WHERE latest' % (', '.join(fields), ', '.join(fields)))
+    return cur.rowcount
+
+
+def _countOwners(cur):
+    cur.execute('UPDATE users SET package_count=0 WHERE package_count<>0')
+    cur.execute('UPDATE users SET package_count=c.count FROM ('
+                    'SELECT owner, count(*) AS count FROM latest_packages '
+                     'WHERE owner IS NOT NULL GROUP BY owner) c '
+                 'WHERE users.id=c.owner')
+
+
+def rebuildLatest(cur):
+    cur.execute('LOCK TABLE latest_packages IN EXCLUSIVE MODE')
+    cur.execute('DELETE FROM latest_packages')
+    count = _copyLatest(cur)
+    _countOwners(cur)
+    notify(cur, PACKAGES)
+    notify(cur, USERS)
+    return count
+
+
+def _createLatestPackages(cur):
+    cur.execute('''\
+CREATE TABLE latest_packages (
+    id          integer PRIMARY KEY,
+    name        text NOT NULL,
+    arch        text NOT NULL,
+    version     text NOT NULL,
+    description text,
+    last_update timestamp without time zone NOT NULL,
+    flag_date   timestamp without time zone,
+    owner       bigint,
+    searchable  tsvector NOT NULL
+);
+CREATE UNIQUE INDEX latest_packages_by_name_arch ON latest_packages (name, arch);
+''')
+    _copyLatest(cur, ('id', 'name', 'arch', 'version', 'description',
+                      'last_update', 'flag_date', 'owner', 'searchable'))
+
+
+def _createPackageDepends(cur):
+    cur.execute('''\
+CREATE TABLE package_depends (
+    package_id  integer NOT NULL,
+    dep_name    text NOT NULL,
+    dep_op      text,
+    dep_version text,
+    optional    boolean NOT NULL DEFAULT false
+);
+CREATE INDEX depends_by_package ON package_depends (package_id);
+CREATE INDEX depends_by_name ON package_depends (dep_name);
+''')
+    cur.execute('SELECT id, depends, opt_depends FROM packages WHERE enabled')
+    for pid, depends, opt_depends in cur.fetchall():
+        updateDepends(cur, pid, depends, opt_depends)
+
+
+def _addLatestBaseName(cur):
+    cur.execute('ALTER TABLE latest_packages ADD COLUMN base_name text')
+    cur.execute('UPDATE latest_packages SET base_name=packages.base_name '
+                  'FROM packages WHERE packages.id=latest_packages.id')
+
+
+def _addPackageCount(cur):
+    cur.execute('ALTER TABLE users '
+                 'ADD COLUMN package_count integer NOT NULL DEFAULT 0')
+    _countOwners(cur)
+    cur.execute('CREATE INDEX user_by_package_count ON users (package_count) '
+                 'WHERE package_count > 0')
+
+
+migrations = [
+    (1, 'latest_packages table', _createLatestPackages),
+    (2, 'latest_packages by last_update',
+     createIndex('latest_packages_by_last_update',
+                 'latest_packages (last_update DESC, id DESC)')),
+    (3, 'latest_packages by name',
+     createIndex('latest_packages_by_name', 'latest_packages (name, id)')),
+    (4, 'latest_packages by flag_date',
+     createIndex('latest_packages_by_flag_date',
+                 'latest_packages (flag_date DESC, id DESC)')),
+    (5, 'latest_packages by owner and last_update',
+     createIndex('latest_packages_by_owner_last_update',
+                 'latest_packages (owner, last_update DESC, id DESC)')),
+    (6, 'latest_packages by arch and last_update',
+     createIndex('latest_packages_by_arch_last_update',
+                 'latest_packages (arch, last_update DESC, id DESC)')),
+    (7, 'latest_packages full-text search',
+     createIndex('latest_packages_by_searchable',
+                 'latest_packages USING gin(searchable)')),
+    (8, 'count latest packages per user', _addPackageCount),
+    (9, 'dependency edges', _createPackageDepends),
+    (10, 'pg_trgm extension', 'CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+    (11, 'latest_packages base_name', _addLatestBaseName),
+    (12, 'latest_packages name trigrams',
+     createIndex('latest_packages_name_trgm',
+                 'latest_packages USING gin(name gin_trgm_ops)')),
+    (13, 'latest_packages base_name trigrams',
+     createIndex('latest_packages_base_name_trgm',
+                 'latest_packages USING gin(base_name gin_trgm_ops)')),
+    (14, 'scanned_dirs table',
+     'CREATE TABLE scanned_dirs ('
+     '    path        text PRIMARY KEY,'
+     '    mtime       bigint NOT NULL'
+     ')'),
+    # Prefix LIKE matches of directories use these, whatever the collation
+    (15, 'packages by file_path prefix',
+     createIndex('package_by_path_prefix',
+                 'packages (file_path text_pattern_ops)')),
+    (16, 'scanned_dirs by path prefix',
+     createIndex('scanned_dirs_by_path_prefix',
+                 'scanned_dirs (path text_pattern_ops)')),
+]
+
 
 def initSchema(pool):
     with pool.cursor() as cur:
@@ -73,3 +327,41 @@ def initSchema(pool):
         for key in schema:
             if key not in result:
                 cur.execute(schema[key])
+    migrate(pool)
+
+
+def migrate(pool):
+    # CREATE INDEX CONCURRENTLY refuses to run inside a transaction block
+    with pool.cursor(
+            isolation_level=extensions.ISOLATION_LEVEL_AUTOCOMMIT) as cur:
+        cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK,))
+        try:
+            cur.execute('SELECT version FROM schema_migrations')
+            applied = set([x[0] for x in cur.fetchall()])
+            for version, description, step in migrations:
+                if version in applied:
+                    continue
+                logging.info('Applying schema migration #%s: %s',
+                             version, description)
+                if getattr(step, 'online', False):
+                    step(cur)
+                    cur.execute('INSERT INTO schema_migrations '
+                                 '(version, description) VALUES (%s, %s)',
+                                (version, description))
+                else:
+                    cur.execute('BEGIN')
+                    try:
+                        if callable(step):
+                            step(cur)
+                        else:
+                            cur.execute(step)
+                        cur.execute('INSERT INTO schema_migrations '
+                                     '(version, description) VALUES (%s, %s)',
+                                    (version, description))
+                    except:
+                        cur.execute('ROLLBACK')
+                        raise
+                    else:
+                        cur.execute('COMMIT')
+        finally:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK,))
@@ -0,0 +1,87 @@
+import time
+from bisect import bisect_left
+from gevent.lock import Semaphore
+
+from archrepo import config
+from archrepo.changes import PACKAGES
+from archrepo.query import escapeLike
+
+
+class NameSuggester(object):
+    def __init__(self, pool, changes, size=None, interval=None):
+        self.pool = pool
+        self.changes = changes
+        if size is None:
+            size = config.xgetint('web', 'suggest-cache-size', 50000)
+        if interval is None:
+            interval = config.xgetint('web', 'suggest-refresh-interval', 60)
+        self.size = size
+        self.interval = interval
+        self.complete = False
+        self._names = []
+        self._generation = None
+        self._loaded = 0
+        self._lock = Semaphore()
+
+    def _stale(self):
+        if self._generation == self.changes.generation(PACKAGES):
+            return False
+        # Do not reload for every package pushed during a busy upload
+        return not self._names or time.time() - self._loaded >= self.interval
+
+    def refresh(self):
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self._refresh()
+
+    def _refresh(self):
+        generation = self.changes.generation(PACKAGES)
+        with self.pool.cursor() as cur:
+            # The most recently updated names are kept in memory
+            cur.execute('SELECT name FROM latest_packages GROUP BY name '
+                         'ORDER BY max(last_update) DESC LIMIT %s',
+                        (self.size,))
+            names = [x[0] for x in cur.fetchall()]
+        names.sort()
+        self.complete = len(names) < self.size
+        self._names = names
+        self._generation = generation
+        self._loaded = time.time()
+
+    def suggest(self, prefix, limit=10):
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        self.refresh()
+        names = self._names
+        matches = set()
+        i = bisect_left(names, prefix)
+        for name in names[i:i + max(limit, 200)]:
+            if not name.startswith(prefix):
+                break
+            matches.add(name)
+        similar = []
+        if len(matches) < limit and not self.complete or not matches:
+            # Not in memory, or probably a typo
+            for name in self._query(prefix, limit):
+                if name.startswith(prefix):
+                    matches.add(name)
+                else:
+                    similar.append(name)
+        # Exact match first, then shorter prefix matches, then typos
+        matches = sorted(matches, key=lambda x: (x != prefix, len(x), x))
+        return (matches + similar)[:limit]
+
+    def _query(self, prefix, limit):
+        with self.pool.cursor() as cur:
+            cur.execute('SELECT name FROM latest_packages '
+                         'WHERE name LIKE %(prefix)s OR name %% %(name)s '
+                         'GROUP BY name '
+                         'ORDER BY bool_or(name LIKE %(prefix)s) DESC, '
+                                  'max(similarity(name, %(name)s)) DESC, '
+                                  'name '
+                         'LIMIT %(limit)s',
+                        {'prefix': escapeLike(prefix) + '%', 'name': prefix,
+                         'limit': limit})
+            return [x[0] for x in cur.fetchall()]
@@ -0,0 +1,110 @@
+import logging
+import os
+import sys
+import time
+import ujson
+from collections import deque
+from contextlib import contextmanager
+from gevent.local import local
+
+from archrepo import config
+
+
+logger = logging.getLogger('archrepo.trace')
+
+
+def newTraceId():
+    return os.urandom(8).encode('hex')
+
+
+def setupTraceLog():
+    path = config.xget('repository', 'trace-log')
+    if path:
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+
+
+class Trace(object):
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.paths = set()
+        self.names = set()
+        self.spans = []
+
+    def addSpan(self, name, start, end, fields):
+        span = dict(fields, span=name, start=start, duration=end - start)
+        self.spans.append(span)
+        logger.debug(ujson.dumps(dict(span, trace=self.id)))
+
+    def asDict(self):
+        return {'id': self.id, 'paths': sorted(self.paths),
+                'names': sorted(self.names), 'spans': self.spans}
+
+
+class Tracer(object):
+    # Recent traces, newest last, and the one of the running greenlet
+    def __init__(self, size=None):
+        if size is None:
+            size = config.xgetint('repository', 'trace-buffer-size', 1000)
+        self._traces = deque(maxlen=size)
+        self._local = local()
+
+    def current(self):
+        return getattr(self._local, 'trace', None)
+
+    def start(self, trace_id=None, path=None, sent=None):
+        trace = Trace(trace_id or newTraceId())
+        if path:
+            trace.paths.add(path)
+        if sent is not None:
+            # Time spent in the ZMQ queue, clocks of one host only
+            trace.addSpan('queue', sent, time.time(), {})
+        self._traces.append(trace)
+        return trace
+
+    @contextmanager
+    def activate(self, trace):
+        previous = self.current()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    @contextmanager
+    def span(self, name, **fields):
+        trace = self.current()
+        start = time.time()
+        try:
+            yield
+        finally:
+            if trace is not None:
+                trace.addSpan(name, start, time.time(), fields)
+
+    @contextmanager
+    def acquire(self, name, manager):
+        # Only the wait for entering manager, a lock usually, is the span
+        with self.span(name):
+            value = manager.__enter__()
+        try:
+            yield value
+        except:
+            if not manager.__exit__(*sys.exc_info()):
+                raise
+        else:
+            manager.__exit__(None, None, None)
+
+    def annotate(self, path=None, name=None):
+        trace = self.current()
+        if trace is not None:
+            if path:
+                trace.paths.add(path)
+            if name:
+                trace.names.add(name)
+
+    def find(self, query):
+        return [x.asDict() for x in reversed(self._traces)
+                if query in x.paths or query in x.names or query == x.id]
@@ -0,0 +1,59 @@
+import time
+from gevent.lock import Semaphore
+from jinja2 import Markup, escape
+
+from archrepo import config
+from archrepo.changes import USERS
+
+
+class UserDirectory(object):
+    def __init__(self, pool, changes, gettext, ttl=None):
+        self.pool = pool
+        self.changes = changes
+        self.gettext = gettext
+        if ttl is None:
+            ttl = config.xgetint('web', 'user-cache-ttl', 300)
+        self.ttl = ttl
+        self.version = 0
+        self._generation = None
+        self._expires = 0
+        self._names = {}
+        self._options = u''
+        self._lock = Semaphore()
+
+    def _stale(self):
+        return (self._generation != self.changes.generation(USERS) or
+                time.time() >= self._expires)
+
+    def _refresh(self):
+        generation = self.changes.generation(USERS)
+        with self.pool.cursor() as cur:
+            cur.execute('SELECT id, username FROM users '
+                         'WHERE package_count > 0 ORDER BY lower(username)')
+            result = cur.fetchall()
+        names = {None: self.gettext('Orphan')}
+        options = [(u'', self.gettext('All')), (u'0', self.gettext('Orphan'))]
+        for uid, username in result:
+            names[uid] = username
+            options.append((unicode(uid), username))
+        self._names = names
+        self._options = u''.join([u'<option value="%s">%s</option>' % (
+            escape(value), escape(label or u'')) for value, label in options])
+        self._generation = generation
+        self._expires = time.time() + self.ttl
+        self.version += 1
+
+    def refresh(self):
+        if self._stale():
+            # Only one greenlet reloads, the others wait for its result
+            with self._lock:
+                if self._stale():
+                    self._refresh()
+
+    def name(self, uid):
+        return self._names.get(uid)
+
+    def options(self, selected=None):
+        key = u'<option value="%s">' % escape(selected or u'')
+        return Markup(self._options.replace(
+            key, key[:-1] + u' selected>', 1))
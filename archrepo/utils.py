@@ -1,3 +1,4 @@
+from gevent.lock import RLock
 from gevent_zeromq import zmq
 
 
@@ -9,3 +10,45 @@ def getZmqContext():
     if _zmq_context is None:
         _zmq_context = zmq.Context()
     return _zmq_context
+
+
+class LockTable(object):
+    # RLocks by key, an entry only lives while it is held or waited for
+    def __init__(self):
+        self._locks = {}
+
+    def __getitem__(self, key):
+        return _TableLock(self._locks, key)
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class _TableLock(object):
+    def __init__(self, locks, key):
+        self._locks = locks
+        self._key = key
+        self._entry = None
+
+    def __enter__(self):
+        entry = self._locks.get(self._key)
+        if entry is None:
+            entry = self._locks[self._key] = [RLock(), 0]
+        entry[1] += 1
+        self._entry = entry
+        try:
+            entry[0].acquire()
+        except:
+            self._unref()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._entry[0].release()
+        self._unref()
+
+    def _unref(self):
+        self._entry[1] -= 1
+        if not self._entry[1]:
+            del self._locks[self._key]
+        self._entry = None
@@ -0,0 +1,160 @@
+import gevent
+import itertools
+import logging
+import os
+import ujson
+from gevent import subprocess
+from gevent.event import AsyncResult
+from gevent.queue import PriorityQueue
+from multiprocessing import cpu_count
+
+from archrepo import config
+
+
+class VerifyCancelled(Exception):
+    pass
+
+
+class VerifyJob(object):
+    def __init__(self, path, verify):
+        self.path = path
+        self.verify = verify
+        self.result = AsyncResult()
+        self.process = None
+
+    @property
+    def cancelled(self):
+        return self.result.ready() and not self.result.successful()
+
+    def cancel(self):
+        if not self.result.ready():
+            self.result.set_exception(VerifyCancelled(self.path))
+        if self.process is not None:
+            self.process.kill()
+
+
+class Verifier(object):
+    def __init__(self, command, workers=None):
+        self.command = command
+        if workers is None:
+            workers = (config.xgetint('repository', 'verify-workers') or
+                       cpu_count())
+        self.workers = workers
+        self._queue = PriorityQueue()
+        self._counter = itertools.count()
+        self._jobs = {}
+        self._greenlets = []
+
+    def _start(self):
+        if not self._greenlets:
+            self._greenlets = [self._spawnWorker()
+                               for _ in xrange(self.workers)]
+
+    def _spawnWorker(self):
+        greenlet = gevent.spawn(self._work)
+        greenlet.link_exception(self._replaceWorker)
+        return greenlet
+
+    def _replaceWorker(self, greenlet):
+        # Not after kill(), which empties the list first
+        if greenlet in self._greenlets:
+            logging.error('Verify worker died, starting another: %r',
+                          greenlet.exception)
+            self._greenlets[self._greenlets.index(greenlet)] = \
+                self._spawnWorker()
+
+    def kill(self):
+        # Workers stop their processes on the way out
+        greenlets, self._greenlets = self._greenlets, []
+        gevent.killall(greenlets)
+        for path in self._jobs.keys():
+            self.cancel(path)
+
+    def verify(self, path, verify=True):
+        # A newer version of the file supersedes the one being verified
+        self.cancel(path)
+        self._start()
+        # Smaller packages first, so they do not wait for huge ones
+        size = os.path.getsize(path) if verify else 0
+        job = self._jobs[path] = VerifyJob(path, verify)
+        self._queue.put((size, next(self._counter), job))
+        try:
+            return job.result.get()
+        finally:
+            if self._jobs.get(path) is job:
+                del self._jobs[path]
+
+    def cancel(self, path):
+        job = self._jobs.pop(path, None)
+        if job is None:
+            return False
+        logging.info('Cancelling verification of %s', path)
+        job.cancel()
+        return True
+
+    def cancelUnder(self, directory):
+        prefix = directory.rstrip('/') + '/'
+        paths = [x for x in self._jobs if x.startswith(prefix)]
+        for path in paths:
+            self.cancel(path)
+        return paths
+
+    def report(self):
+        return {'jobs': len(self._jobs), 'queued': self._queue.qsize(),
+                'workers': len(self._greenlets)}
+
+    def _spawn(self):
+        return subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+
+    def _stopProcess(self, proc):
+        try:
+            proc.kill()
+        except OSError:
+            # Already gone
+            pass
+        proc.wait()
+
+    def _work(self):
+        proc = None
+        try:
+            while True:
+                _, _, job = self._queue.get()
+                if job.cancelled:
+                    continue
+                try:
+                    if proc is None:
+                        proc = self._spawn()
+                    proc = self._verifyWith(proc, job)
+                except Exception as e:
+                    logging.error('Failed verifying %s', job.path,
+                                  exc_info=True)
+                    if not job.result.ready():
+                        job.result.set((1, '', str(e)))
+                    if proc is not None:
+                        self._stopProcess(proc)
+                        proc = None
+        finally:
+            if proc is not None:
+                self._stopProcess(proc)
+
+    def _verifyWith(self, proc, job):
+        # Returns the process to reuse for the next job, if any
+        job.process = proc
+        try:
+            proc.stdin.write(ujson.dumps([job.path, job.verify]) + '\n')
+            proc.stdin.flush()
+            line = proc.stdout.readline()
+        except (IOError, OSError):
+            line = ''
+        finally:
+            job.process = None
+        if not line:
+            # Killed for cancellation, or crashed
+            self._stopProcess(proc)
+            if not job.result.ready():
+                job.result.set((1, '', 'verification process died'))
+            return None
+        if not job.result.ready():
+            job.result.set(tuple(ujson.loads(line)))
+        return proc
@@ -5,20 +5,40 @@ import hmac
 import logging
 import math
 import os
+import socket
 import sys
+import tempfile
 import time
 import ujson
+import urllib
 import urllib2
-from babel.dates import format_date
+from babel.core import default_locale
 from base64 import b64encode
+from collections import OrderedDict
+from datetime import datetime
+from distutils.version import LooseVersion
+from cherrypy.lib import cptools, httputil
 from gevent import monkey
 from gevent.pywsgi import WSGIServer
 from pkg_resources import resource_filename
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from archrepo import config
-from archrepo.query import CursorPool, SubCursorPool
+from archrepo.cache import PageCache
+from archrepo.changes import ChangeListener, notify, PACKAGES, USERS
+from archrepo.compress import Compression, StaticAssets
+from archrepo.dates import DateFormatter
+from archrepo.download import DownloadHandler, PackageDownloads
+from archrepo.monitor import AdminPages
+from archrepo.query import CountCache, CursorPool, PackageFilter
+from archrepo.query import SubCursorPool
+from archrepo.query import estimateRows, queryKey
+from archrepo.query import SEEK_KEYS, decodeSeekToken, encodeSeekToken
+from archrepo.query import seekCondition
 from archrepo.repo import FakeProcessor
+from archrepo.schema import parseDepend
+from archrepo.suggest import NameSuggester
+from archrepo.users import UserDirectory
 
 
 monkey.patch_socket()
@@ -26,6 +46,10 @@ monkey.patch_ssl()
 
 FIELDS = ('id', 'name', 'arch', 'version', 'description', 'last_update',
           'flag_date', 'owner')
+DETAIL_FIELDS = ('id', 'name', 'arch', 'version', 'description', 'url',
+                 'pkg_group', 'license', 'packager', 'base_name', 'build_date',
+                 'size', 'depends', 'opt_depends', 'enabled', 'latest',
+                 'last_update', 'flag_date', 'owner')
 USER_FIELDS = ('id', 'username', 'email', 'title', 'realname')
 AVAILABLE_LIMITS = ('25', '50', '100', '250', 'all')
 
@@ -95,10 +119,14 @@ class FluxAuth(Auth):
             values = [uid]
             for field in USER_FIELDS[1:]:
                 values.append(info.get(field))
-            cur.execute('INSERT INTO users (%s) VALUES (%s) RETURNING %s' % (
-                ', '.join(USER_FIELDS), ', '.join(['%s'] * len(USER_FIELDS)),
-                ', '.join(USER_FIELDS)), tuple(values))
-            result = cur.fetchone()
+            with self.pool.cursor() as cur:
+                cur.execute(
+                    'INSERT INTO users (%s) VALUES (%s) RETURNING %s' % (
+                        ', '.join(USER_FIELDS),
+                        ', '.join(['%s'] * len(USER_FIELDS)),
+                        ', '.join(USER_FIELDS)), tuple(values))
+                result = cur.fetchone()
+                notify(cur, USERS)
         userinfo = dict(zip(USER_FIELDS, result))
         return True, userinfo
 
@@ -107,10 +135,9 @@ class ArchRepoApplication(object):
     def __init__(self, pool):
         self.cursorPool = CursorPool(
             config.xgetint('web', 'concurrent-queries', 16))
+        self._sub_cursor_pools = OrderedDict()
+        self.max_sub_cursor_pools = 1024
         self.pool = pool
-        self._env = Environment(loader=FileSystemLoader(
-            resource_filename('archrepo', 'templates')),
-                                extensions=['jinja2.ext.i18n'])
         try:
             self.trans = gettext.translation(
                 'archrepo', os.path.join(
@@ -118,8 +145,32 @@ class ArchRepoApplication(object):
                     'share/locale'))
         except IOError:
             self.trans = gettext.NullTranslations()
-        #noinspection PyUnresolvedReferences
-        self._env.install_gettext_translations(self.trans)
+        self.compression = Compression()
+        self.static = StaticAssets(
+            resource_filename('archrepo', 'templates/static'),
+            self.compression)
+        self._env = createEnvironment(self.trans, self.static)
+
+        self.changes = ChangeListener(pool)
+        self.changes.start()
+        self.users = UserDirectory(pool, self.changes, self.gettext)
+        self.pages = PageCache(
+            config.xgetint('web', 'page-cache-size', 64) * 1024 * 1024)
+        self._locale = str(default_locale('LC_TIME'))
+        self.formatDate = DateFormatter(self._locale)
+        self.keyset = config.xgetbool('web', 'keyset-pagination', True)
+        self.counts = CountCache(
+            config.xgetint('web', 'count-cache-size', 1024))
+        self.estimate_above = config.xgetint('web', 'estimate-count-above', 0)
+        self.stream_all = config.xgetbool('web', 'stream-all', True)
+        self.stream_rows = config.xgetint('web', 'stream-rows', 500)
+        self.stream_chunk_size = config.xgetint('web', 'stream-chunk-size',
+                                                16384)
+
+        self.suggester = NameSuggester(pool, self.changes)
+
+        self.api = ArchRepoApi(self)
+        self.admin = AdminPages(self)
 
         if config.has_section('flux-sso'):
             self.auth = FluxAuth(pool)
@@ -132,99 +183,239 @@ class ArchRepoApplication(object):
         else:
             return message
 
+    def _pageKey(self, userinfo, sort, arch, maintainer, q, limit, page,
+                 flagged, last_update, after, before, name):
+        if arch is not None and not isinstance(arch, list):
+            arch = [arch]
+        return (
+            userinfo and userinfo['id'], self._locale,
+            sort and sort.lower().strip(),
+            arch and tuple(sorted(set(arch))),
+            maintainer, q and ' '.join(q.split()), limit, page, flagged,
+            last_update and last_update.strip(), after, before,
+            name and name.strip().lower())
+
+    def _send(self, page):
+        body = self.compression.send(page.body, page.etag, page.encoded)
+        headers = cherrypy.response.headers
+        headers['Last-Modified'] = httputil.HTTPDate(page.last_modified)
+        # Both raise a 304 if the client already has this page
+        cptools.validate_etags()
+        cptools.validate_since()
+        return body
+
     @cherrypy.expose
     def query(self, sort=None, arch=None, maintainer=None, q=None, limit=None,
-              page=None, flagged=None, last_update=None):
+              page=None, flagged=None, last_update=None, after=None,
+              before=None, name=None):
         userinfo = self.auth.getUserInfo()
-
-        sql = 'SELECT %s FROM packages' % ', '.join(FIELDS)
-        sort_list = []
-        where_list = ['latest']
-        desc = True
-        values = {}
-
-        if arch is not None:
-            if not isinstance(arch, list):
-                arch = [arch]
-            where_list.append('arch IN %(arch)s')
-            values['arch'] = tuple(arch)
-        else:
-            arch = ()
-
-        if last_update is not None and last_update.strip():
-            where_list.append('last_update > %(last_update)s')
-            values['last_update'] = last_update
-        else:
-            last_update = ''
-
-        if flagged == '1':
-            where_list.append('flag_date IS NOT NULL')
-        elif flagged == '2':
-            where_list.append('flag_date IS NULL')
-        else:
-            flagged = '0'
-
-        if maintainer is not None and maintainer.isdigit():
-            if int(maintainer):
-                where_list.append('owner=%(owner)s')
-                values['owner'] = int(maintainer)
-            else:
-                where_list.append('owner IS NULL')
-
-        if sort:
-            for part in sort.lower().split(','):
-                if part in ('last_update', 'name', 'arch', 'flag_date'):
-                    sort_list.append(part)
-                if part in ('name', 'arch', 'asc'):
-                    desc = False
-                if part in ('desc',):
-                    desc = True
-        if not sort_list:
-            sort = 'last_update'
-            sort_list.append(sort)
-            desc = True
-
-        if q is not None and q.strip():
-            sql = ', '.join((sql, "to_tsquery(%(lang)s, %(q)s) query"))
-            values['lang'] = 'english'
-            values['q'] = '&'.join(q.split())
-            where_list.append('searchable @@ query')
-            sort_list.append('ts_rank_cd(searchable, query)')
-            desc = True
-        else:
-            q = ''
-
+        self.users.refresh()
+        key = self._pageKey(userinfo, sort, arch, maintainer, q, limit, page,
+                            flagged, last_update, after, before, name)
+        generation = (self.changes.generation(PACKAGES), self.users.version)
+        if limit == 'all' and self.stream_all:
+            cherrypy.response.stream = True
+            cherrypy.response.headers['Content-Type'] = \
+                'text/html;charset=utf-8'
+            return self._chunks(self._query(
+                userinfo, sort, arch, maintainer, q, limit, page, flagged,
+                last_update, after, before, name, stream=True))
+        cached = self.pages.get(key, generation)
+        if cached is None:
+            body = self._query(userinfo, sort, arch, maintainer, q, limit,
+                               page, flagged, last_update, after, before,
+                               name)
+            cached = self.pages.put(key, body.encode('utf-8'), generation)
+        cherrypy.response.headers['Content-Type'] = 'text/html;charset=utf-8'
+        return self._send(cached)
+
+    def _subCursorPool(self):
+        # Cursors live in this process only, so they are not kept in the
+        # session, which may be shared with other worker processes
+        #noinspection PyUnresolvedReferences
+        sid = cherrypy.session.id
+        cpool = self._sub_cursor_pools.pop(sid, None)
+        if cpool is None:
+            cpool = SubCursorPool(
+                self.cursorPool,
+                config.xgetint('web', 'concurrent-queries-per-session', 1))
+        self._sub_cursor_pools[sid] = cpool
+        while len(self._sub_cursor_pools) > self.max_sub_cursor_pools:
+            self._sub_cursor_pools.popitem(last=False)
+        return cpool
+
+    def _chunks(self, fragments):
+        buf, buffered = [], 0
+        for fragment in fragments:
+            fragment = fragment.encode('utf-8')
+            buf.append(fragment)
+            buffered += len(fragment)
+            if buffered >= self.stream_chunk_size:
+                yield ''.join(buf)
+                buf, buffered = [], 0
+        if buf:
+            yield ''.join(buf)
+
+    def _rows(self, result):
+        for row in result:
+            row = dict(zip(FIELDS, row))
+            row['last_update'] = self.formatDate(row['last_update'])
+            row['flag_date'] = ('' if row['flag_date'] is None else
+                                self.formatDate(row['flag_date']))
+            row['maintainer'] = self.users.name(row['owner'])
+            yield row
+
+    def _count(self, from_where, values, estimate=False):
+        key = queryKey(from_where, values)
+        generation = self.changes.generation(PACKAGES)
+        result = self.counts.get(key, generation)
+        if result is not None:
+            return result
+        with self.pool.cursor() as cur:
+            if estimate and self.estimate_above:
+                rows = estimateRows(cur, 'SELECT 1' + from_where, values)
+                if rows is not None and rows > self.estimate_above:
+                    result = rows, True
+            if result is None:
+                cur.execute('SELECT count(*)' + from_where, values)
+                result = cur.fetchone()[0], False
+        self.counts.put(key, generation, result)
+        return result
+
+    def _seek(self, f, limit, after, before):
+        key, desc = f.sort_list[0], f.desc
+        where_list, values = f.where_list, f.values
+        seek = None
+        forward = before is None
+        token = after if forward else before
+        if token is not None:
+            seek = decodeSeekToken(token, key)
+            if seek is None:
+                raise cherrypy.HTTPError(400, 'Invalid page token')
+        scan_desc = desc if forward or seek is None else not desc
+        if seek is not None:
+            where_list = where_list + [seekCondition(key, seek[0], scan_desc)]
+            values = dict(values, seek_value=seek[0], seek_id=seek[1])
+        sql = 'SELECT %s FROM %s' % (', '.join(FIELDS), ', '.join(f.from_list))
         if where_list:
             sql = ' WHERE '.join((sql, ' AND '.join(where_list)))
-
-        if sort_list:
-            sql = ' ORDER BY '.join((sql, ', '.join(sort_list)))
-            if desc:
-                sql = ' '.join((sql, 'DESC'))
+        direction = 'DESC' if scan_desc else 'ASC'
+        sql += ' ORDER BY %s %s, id %s LIMIT %d' % (
+            key, direction, direction, limit + 1)
+        with self.pool.cursor() as cur:
+            logging.debug('SQL: %s, VALUES: %r', sql, values)
+            cur.execute(sql, values)
+            result = cur.fetchall()
+        more = len(result) > limit
+        result = result[:limit]
+        if seek is None:
+            has_prev, has_next = False, more
+        elif forward:
+            has_prev, has_next = True, more
+        else:
+            result.reverse()
+            has_prev, has_next = more, True
+        key_index = FIELDS.index(key)
+        prev_token = next_token = None
+        if result and has_prev:
+            prev_token = encodeSeekToken(
+                key, result[0][key_index], result[0][0])
+        if result and has_next:
+            next_token = encodeSeekToken(
+                key, result[-1][key_index], result[-1][0])
+        return result, prev_token, next_token
+
+    def _query(self, userinfo, sort, arch, maintainer, q, limit, page,
+               flagged, last_update, after, before, name=None, stream=False):
+        f = PackageFilter(sort, arch, maintainer, q, flagged, last_update,
+                          name)
+        arch, q, flagged, last_update = f.arch, f.q, f.flagged, f.last_update
+        where_list, values = f.where_list, f.values
+        sort_list, desc = f.sort_list, f.desc
+        from_where = f.from_where
+        sql = f.select(FIELDS)
 
         if limit not in AVAILABLE_LIMITS[1:]:
             limit = AVAILABLE_LIMITS[0]
-        if limit != 'all':
-            #noinspection PyUnresolvedReferences
-            if 'sub_cursor_pool' in cherrypy.session:
-                #noinspection PyUnresolvedReferences
-                cpool = cherrypy.session['sub_cursor_pool']
+
+        seek_key = None
+        if (self.keyset and limit != 'all' and len(sort_list) == 1 and
+                sort_list[0] in SEEK_KEYS):
+            seek_key = sort_list[0]
+            if (after is None and before is None and page is not None and
+                    page.isdigit() and int(page) > 1):
+                # Jumping to an arbitrary page needs an offset
+                seek_key = None
+
+        # Links come from the normalized values, as the page cache key,
+        # so every query string sharing a cached page gets the same links
+        params = [('sort', sort and sort.lower().strip())]
+        params += [('arch', x) for x in arch]
+        params += [('maintainer', maintainer), ('q', q), ('name', f.name),
+                   ('last_update', last_update), ('limit', limit)]
+        if flagged != '0':
+            params.append(('flagged', flagged))
+        parts = ['%s=%s' % (k, urllib.quote_plus(
+                     v.encode('utf-8') if isinstance(v, unicode) else v))
+                 for k, v in params if v]
+        prev_query = next_query = None
+        count_estimated = False
+        if seek_key is not None:
+            count, count_estimated = self._count(from_where, values)
+            all_pages = int(math.ceil(float(count) / int(limit)))
+            result, prev_token, next_token = self._seek(
+                f, int(limit), after, before)
+            if not prev_token:
+                page = 1
+            elif page is not None and page.isdigit():
+                page = max(2, int(page))
+                if not count_estimated:
+                    page = min(all_pages, page)
             else:
-                cpool = SubCursorPool(
-                    self.cursorPool,
-                    config.xgetint('web', 'concurrent-queries-per-session', 1))
-                #noinspection PyUnresolvedReferences
-                cherrypy.session['sub_cursor_pool'] = cpool
-
-            cursor = cpool.getCursor(self.pool, sql % values, sql, values)
-            count = cursor.count
+                page = 2
+            if count_estimated:
+                all_pages = max(all_pages, page)
+            if prev_token:
+                prev_query = '&'.join(parts + [
+                    'page=%d' % (page - 1), 'before=' + prev_token])
+            if next_token:
+                next_query = '&'.join(parts + [
+                    'page=%d' % (page + 1), 'after=' + next_token])
+        elif limit != 'all':
+            cpool = self._subCursorPool()
+            cursor = cpool.getCursor(self.pool, queryKey(sql, values), sql,
+                                     values)
+            count, count_estimated = self._count(from_where, values,
+                                                 estimate=bool(q))
             all_pages = int(math.ceil(float(count) / int(limit)))
             if page is not None and page.isdigit():
-                page = min(all_pages, max(1, int(page)))
+                page = max(1, int(page))
+                # The estimate may be short, an empty page ends paging then
+                if not count_estimated:
+                    page = min(all_pages, page)
             else:
                 page = 1
             offset = (page - 1) * int(limit)
             result = cursor.fetch(int(limit), offset)
+            if count_estimated:
+                all_pages = max(all_pages, page)
+            if page > 1:
+                prev_query = '&'.join(parts + ['page=%d' % (page - 1)])
+            if count_estimated:
+                # Trust the page we got more than the planner
+                has_next = len(result) == int(limit)
+            else:
+                has_next = page < all_pages
+            if has_next:
+                next_query = '&'.join(parts + ['page=%d' % (page + 1)])
+        elif stream:
+            page = 1
+            all_pages = 1
+            count, count_estimated = self._count(from_where, values)
+            logging.debug('SQL: %s, VALUES: %r', sql, values)
+            # Rows are read through a server-side cursor while rendering
+            result = self.pool.fetchiter(sql, values, name='_all',
+                                        size=self.stream_rows)
         else:
             page = 1
             all_pages = 1
@@ -233,28 +424,18 @@ class ArchRepoApplication(object):
                 cur.execute(sql, values)
                 result = cur.fetchall()
             count = len(result)
-        with self.pool.cursor() as cur:
-            cur.execute('SELECT id, username FROM users')
-            users = [(None, self.gettext('All')), ('0', self.gettext('Orphan'))]
-            for val, label in cur.fetchall():
-                users.append((str(val), label))
-            users_dict = dict(users)
-
-        result = [dict(zip(FIELDS, x)) for x in result]
-        for row in result:
-            row['last_update'] = format_date(row['last_update'])
-            row['flag_date'] = ('' if row['flag_date'] is None else
-                                format_date(row['flag_date']))
-            row['maintainer'] = users_dict.get(str(row['owner'] or '0'))
-        parts = cherrypy.request.query_string.split('&')
-        pager = '&'.join([x for x in parts if not x.startswith('page=')] + ['page='])
+        result = self._rows(result)
+        if not stream:
+            result = list(result)
         sorter = '&'.join([x for x in parts if not x.startswith('sort=')] + ['sort='])
         tmpl = self._env.get_template('packages.html')
-        return tmpl.render(
-            packages=result, userinfo=userinfo, q=q, arch=arch,
+        return (tmpl.generate if stream else tmpl.render)(
+            packages=result, userinfo=userinfo, q=q, name=f.name, arch=arch,
             last_update=last_update, flagged=flagged, page=page, count=count,
+            count_estimated=count_estimated,
             all_pages=all_pages, limit=limit, all_limits=AVAILABLE_LIMITS,
-            pager=pager, sorter=sorter, maintainer=maintainer, users=users,
+            prev_query=prev_query, next_query=next_query, sorter=sorter,
+            maintainer_options=self.users.options(maintainer),
             base_url=config.get('web', 'external-base-url').rstrip('/'),
             title=config.get('web', 'title'),
             favicon=config.get('web', 'favicon'),
@@ -304,22 +485,232 @@ class ArchRepoApplication(object):
         if redirect_url:
             raise cherrypy.HTTPRedirect(redirect_url)
 
-    #@cherrypy.expose
-    #def detail(self, id):
-    #    pass
+    def _findPackage(self, name, arch):
+        with self.pool.cursor() as cur:
+            if arch:
+                cur.execute("SELECT id FROM latest_packages "
+                             "WHERE name=%s AND arch IN (%s, 'any') "
+                             "ORDER BY arch='any' LIMIT 1", (name, arch))
+            else:
+                cur.execute('SELECT id FROM latest_packages WHERE name=%s '
+                             'ORDER BY id LIMIT 1', (name,))
+            result = cur.fetchone()
+        if not result:
+            raise cherrypy.NotFound()
+        return result[0]
+
+    @cherrypy.expose
+    def detail(self, id=None, name=None, arch=None):
+        if id is None and name:
+            id = str(self._findPackage(name, arch))
+        if id is None or not id.isdigit():
+            raise cherrypy.NotFound()
+        userinfo = self.auth.getUserInfo()
+        self.users.refresh()
+        key = ('detail', int(id), userinfo and userinfo['id'], self._locale)
+        generation = (self.changes.generation(PACKAGES), self.users.version)
+        cached = self.pages.get(key, generation)
+        if cached is None:
+            body = self._detail(userinfo, int(id))
+            cached = self.pages.put(key, body.encode('utf-8'), generation)
+        cherrypy.response.headers['Content-Type'] = 'text/html;charset=utf-8'
+        return self._send(cached)
+
+    def _detail(self, userinfo, pid):
+        with self.pool.cursor() as cur:
+            cur.execute('SELECT %s FROM packages WHERE id=%%s' %
+                        ', '.join(DETAIL_FIELDS), (pid,))
+            result = cur.fetchone()
+            if not result:
+                raise cherrypy.NotFound()
+            package = dict(zip(DETAIL_FIELDS, result))
+            cur.execute('SELECT id, version, enabled, latest, last_update '
+                         'FROM packages WHERE name=%s AND arch=%s',
+                        (package['name'], package['arch']))
+            versions = [dict(zip(('id', 'version', 'enabled', 'latest',
+                                  'last_update'), x)) for x in cur.fetchall()]
+            # Served by the dep_name index instead of unnesting every array
+            sql = ('SELECT l.id, l.name, l.arch, l.version, d.dep_op, '
+                          'd.dep_version, d.optional '
+                     'FROM package_depends d '
+                     'JOIN latest_packages l ON l.id=d.package_id '
+                    'WHERE d.dep_name=%(name)s')
+            if package['arch'] != 'any':
+                sql += " AND l.arch IN (%(arch)s, 'any')"
+            cur.execute(sql + ' ORDER BY l.name, l.arch', package)
+            required_by = [dict(zip(('id', 'name', 'arch', 'version', 'op',
+                                     'dep_version', 'optional'), x))
+                           for x in cur.fetchall()]
+
+        versions.sort(key=lambda x: LooseVersion(x['version']), reverse=True)
+        for version in versions:
+            version['last_update'] = self.formatDate(version['last_update'])
+        for key in ('depends', 'opt_depends'):
+            package[key] = [((parseDepend(x) or (x,))[0], x)
+                            for x in package[key] or ()]
+        package['last_update'] = self.formatDate(package['last_update'])
+        package['flag_date'] = ('' if package['flag_date'] is None else
+                                self.formatDate(package['flag_date']))
+        package['build_date'] = ('' if package['build_date'] is None else
+                                 self.formatDate(datetime.utcfromtimestamp(
+                                                 package['build_date'])))
+        package['maintainer'] = self.users.name(package['owner'])
+        # Written by the packager, never link javascript: and the like
+        url = package['url'] or ''
+        package['link'] = None
+        if url.lower().startswith(('http://', 'https://')):
+            package['link'] = url
+        tmpl = self._env.get_template('detail.html')
+        return tmpl.render(
+            package=package, versions=versions, required_by=required_by,
+            userinfo=userinfo,
+            base_url=config.get('web', 'external-base-url').rstrip('/'),
+            title=config.get('web', 'title'),
+            favicon=config.get('web', 'favicon'))
+
+
+class ArchRepoApi(object):
+    def __init__(self, app):
+        self.app = app
+        self.default_limit = config.xgetint('web', 'api-default-limit', 100)
+        self.max_limit = config.xgetint('web', 'api-max-limit', 1000)
+        self.suggest_limit = config.xgetint('web', 'suggest-limit', 10)
+
+    def _row(self, row):
+        row = dict(zip(FIELDS, row))
+        for key in ('last_update', 'flag_date'):
+            if row[key] is not None:
+                row[key] = row[key].isoformat()
+        row['maintainer'] = row['owner'] and self.app.users.name(row['owner'])
+        return row
+
+    def _serialize(self, rows, next_token=None):
+        yield '{"packages":['
+        sep = ''
+        chunk = []
+        for row in rows:
+            chunk.append(self._row(row))
+            if len(chunk) >= self.app.stream_rows:
+                yield sep + ujson.dumps(chunk)[1:-1]
+                sep, chunk = ',', []
+        if chunk:
+            yield sep + ujson.dumps(chunk)[1:-1]
+        yield '],"next":%s}' % ujson.dumps(next_token)
+
+    @cherrypy.expose
+    def packages(self, sort=None, arch=None, maintainer=None, q=None,
+                 flagged=None, last_update=None, limit=None, after=None,
+                 name=None):
+        app = self.app
+        app.users.refresh()
+        # Results are always ordered by a single column, never by rank
+        f = PackageFilter(sort, arch, maintainer, q, flagged, last_update,
+                          name, rank=False)
+        del f.sort_list[1:]
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+
+        if limit == 'all':
+            cherrypy.response.stream = True
+            return self._serialize(app.pool.fetchiter(
+                f.select(FIELDS), f.values, name='_api',
+                size=app.stream_rows))
+
+        try:
+            limit = min(self.max_limit, max(1, int(limit)))
+        except (TypeError, ValueError):
+            limit = self.default_limit
+        key = ('api', queryKey(f.select(FIELDS), f.values), limit, after)
+        generation = (app.changes.generation(PACKAGES), app.users.version)
+        cached = app.pages.get(key, generation)
+        if cached is None:
+            result, _, next_token = app._seek(f, limit, after, None)
+            cached = app.pages.put(
+                key, ''.join(self._serialize(result, next_token)), generation)
+        return app._send(cached)
+
+    @cherrypy.expose
+    def suggest(self, prefix=None, limit=None):
+        try:
+            limit = min(self.suggest_limit, max(1, int(limit)))
+        except (TypeError, ValueError):
+            limit = self.suggest_limit
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return ujson.dumps(self.app.suggester.suggest(prefix or '', limit))
+
+
+def createEnvironment(trans, static):
+    path = config.xget('web', 'template-cache-path')
+    if path:
+        try:
+            os.makedirs(path, 0700)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    env = Environment(
+        loader=FileSystemLoader(resource_filename('archrepo', 'templates')),
+        extensions=['jinja2.ext.i18n'],
+        auto_reload=config.xgetbool('web', 'template-auto-reload', False),
+        bytecode_cache=FileSystemBytecodeCache(path) if path else
+                       FileSystemBytecodeCache())
+    #noinspection PyUnresolvedReferences
+    env.install_gettext_translations(trans)
+    # Content-hashed names of static files, cached by browsers forever
+    env.globals['static'] = static.url
+    # Compile now instead of in the first requests
+    for name in env.list_templates(extensions=('html',)):
+        env.get_template(name)
+    return env
 
 
 class ArchRepoWebServer(WSGIServer):
-    def __init__(self, pool):
-        host = config.xget('web', 'host', default='*')
-        port = config.xgetint('web', 'port', default=8080)
-        super(ArchRepoWebServer, self).__init__('%s:%d' % (host, port), log=None)
+    handler_class = DownloadHandler
+
+    def __init__(self, pool, listener=None):
+        # Pre-forked workers share the listener, the next request of a
+        # session may go to any of them
+        shared = listener is not None or config.has_option(
+            'web', 'session-path')
+        if listener is None:
+            host = config.xget('web', 'host', default='*')
+            port = config.xgetint('web', 'port', default=8080)
+            listener = '%s:%d' % (host, port)
+        super(ArchRepoWebServer, self).__init__(listener, log=None)
         cherrypy.server.unsubscribe()
-        static_dir = resource_filename('archrepo', 'templates/static')
-        self.application = cherrypy.tree.mount(
-            ArchRepoApplication(pool), config={
-                '/': {'tools.sessions.on': True},
-                '/static': {'tools.staticdir.on': True,
-                            'tools.staticdir.dir': static_dir}})
-        self.application.log.access_log.level = self.application.log.access_log.parent.level
-        self.application.log.error_log.level = self.application.log.error_log.parent.level
+        root = {'tools.sessions.on': True, 'tools.compress.on': True}
+        if shared:
+            path = config.xget('web', 'session-path', default=os.path.join(
+                tempfile.gettempdir(), 'archrepo-sessions'))
+            try:
+                os.makedirs(path, 0700)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+            # Default implicit locking, the session file stays locked
+            # while a worker handles a request of that session
+            root.update({'tools.sessions.storage_type': 'file',
+                         'tools.sessions.storage_path': path})
+        application = ArchRepoApplication(pool)
+        # Runs after the encode tool, on the final bytes
+        cherrypy.tools.compress = cherrypy.Tool(
+            'before_finalize', application.compression.compressResponse,
+            priority=80)
+        app = cherrypy.tree.mount(
+            application, config={
+                '/': root,
+                '/api': {'tools.sessions.on': False},
+                '/static': {'tools.sessions.on': False,
+                            'tools.compress.on': False}})
+        app.log.access_log.level = app.log.access_log.parent.level
+        app.log.error_log.level = app.log.error_log.parent.level
+        # Package files are sent by the kernel, bypassing CherryPy
+        self.application = PackageDownloads(pool, app)
+
+
+def createListener():
+    host = config.xget('web', 'host', default='*')
+    port = config.xgetint('web', 'port', default=8080)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('' if host == '*' else host, port))
+    sock.listen(config.xgetint('web', 'backlog', 256))
+    return sock
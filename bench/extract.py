@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Compares reading .PKGINFO and verifying whole packages per format:
+#
+#     $ python bench/extract.py                 # a generated package
+#     $ python bench/extract.py /var/www/repo/x86_64/*.pkg.tar.*
+
+import lzma
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import time
+import zlib
+from StringIO import StringIO
+from argparse import ArgumentParser
+from zstandard import ZstdCompressor
+
+from archrepo.pkginfo import openPackage, readPkginfo
+
+
+def buildTarball(size):
+    buf = StringIO()
+    f = tarfile.open(fileobj=buf, mode='w')
+
+    def add(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        f.addfile(info, StringIO(data))
+
+    add('.PKGINFO', 'pkgname = bench\npkgver = 1.0-1\narch = x86_64\n'
+                    'size = %d\n' % size)
+    words = ['archrepo', 'package', 'library', 'usr', 'share', 'lib', 'bin',
+             'include', 'config', 'data', 'python', 'locale']
+    rand = random.Random(0)
+    written, index = 0, 0
+    while written < size:
+        # Half text, half binary-ish, roughly like a real package
+        text = ' '.join(rand.choice(words) for _ in xrange(20000))
+        binary = ''.join(chr(rand.randrange(256)) for _ in xrange(20000))
+        add('usr/share/bench/%d.txt' % index, text)
+        add('usr/lib/bench/%d.so' % index, binary * 4)
+        written += len(text) + len(binary) * 4
+        index += 1
+    f.close()
+    return buf.getvalue()
+
+
+def compressGzip(data):
+    c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+def buildPackages(directory, size):
+    tarball = buildTarball(size)
+    paths = []
+    for suffix, compress in (
+            ('.pkg.tar.gz', compressGzip),
+            ('.pkg.tar.xz', lzma.compress),
+            ('.pkg.tar.zst', ZstdCompressor(level=19).compress)):
+        path = os.path.join(directory, 'bench-1.0-1-x86_64' + suffix)
+        with open(path, 'wb') as f:
+            f.write(compress(tarball))
+        paths.append(path)
+    return paths
+
+
+def measure(path, verify, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        readPkginfo(openPackage(path), verify)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def tarSize(path):
+    total = 0
+    decoded = openPackage(path)
+    while True:
+        data = decoded.read(1024 * 1024)
+        if not data:
+            return total
+        total += len(data)
+
+
+if __name__ == '__main__':
+    p = ArgumentParser('extract.py')
+    p.add_argument('packages', metavar='PACKAGE', nargs='*',
+                   help='package files, a package is generated in every '
+                        'format if none given')
+    p.add_argument('-s', '--size', type=int, default=32,
+                   help='MB of the generated package, default is 32')
+    p.add_argument('-r', '--repeat', type=int, default=3,
+                   help='runs of every package, the best one is reported')
+    args = p.parse_args()
+
+    directory = None
+    try:
+        if args.packages:
+            paths = args.packages
+        else:
+            directory = tempfile.mkdtemp(prefix='archrepo-bench-')
+            paths = buildPackages(directory, args.size * 1024 * 1024)
+        for path in paths:
+            size = tarSize(path)
+            pkginfo = measure(path, False, args.repeat)
+            verify = measure(path, True, args.repeat)
+            print '%s: %.1f MB -> %.1f MB' % (
+                os.path.basename(path), os.path.getsize(path) / 1048576.0,
+                size / 1048576.0)
+            print '    .PKGINFO: %.2f ms, verify: %.2f s, %.1f MB/s' % (
+                pkginfo * 1000, verify, size / 1048576.0 / verify)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# Times rendering a /query page of fake rows, no database is needed:
+#
+#     $ python bench/render.py -n 250 -r 200
+
+import gettext
+import time
+from argparse import ArgumentParser
+from babel.dates import format_date
+from datetime import datetime, timedelta
+from jinja2 import Markup
+from pkg_resources import resource_filename
+
+from archrepo.compress import Compression, StaticAssets
+from archrepo.dates import DateFormatter
+from archrepo.web import AVAILABLE_LIMITS, FIELDS, createEnvironment
+
+
+def buildRows(count):
+    now = datetime.utcnow()
+    return [(i, u'package-%d' % i, ('any', 'i686', 'x86_64')[i % 3],
+             u'1.0.%d-1' % i, u'Description of the fake package %d' % i,
+             now - timedelta(hours=i * 7), now if i % 10 == 0 else None,
+             i % 5 or None) for i in xrange(count)]
+
+
+def formatRows(result, formatDate):
+    rows = []
+    for row in result:
+        row = dict(zip(FIELDS, row))
+        row['last_update'] = formatDate(row['last_update'])
+        row['flag_date'] = ('' if row['flag_date'] is None else
+                            formatDate(row['flag_date']))
+        row['maintainer'] = row['owner'] and u'user%d' % row['owner']
+        rows.append(row)
+    return rows
+
+
+def render(tmpl, rows):
+    return tmpl.render(
+        packages=rows, userinfo=None, q=u'', name=u'', arch=[],
+        last_update=u'', flagged=None, page=1, count=len(rows) * 10,
+        count_estimated=False, all_pages=10, limit=str(len(rows)),
+        all_limits=AVAILABLE_LIMITS, prev_query=None,
+        next_query=u'page=2', sorter=u'sort=',
+        maintainer_options=Markup(u''.join(
+            u'<option value="%d">user%d</option>' % (i, i)
+            for i in xrange(200))),
+        base_url=u'', title=u'ArchRepo', favicon=u'',
+        all_arch=('any', 'i686', 'x86_64'))
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+
+if __name__ == '__main__':
+    p = ArgumentParser('render.py')
+    p.add_argument('-n', '--rows', type=int, default=250,
+                   help='Rows per page, default is 250')
+    p.add_argument('-r', '--repeat', type=int, default=100,
+                   help='Runs of every step, the best one is reported')
+    args = p.parse_args()
+
+    result = buildRows(args.rows)
+    start = time.time()
+    compression = Compression()
+    static = StaticAssets(resource_filename('archrepo', 'templates/static'),
+                          compression)
+    tmpl = createEnvironment(gettext.NullTranslations(),
+                             static).get_template('packages.html')
+    print 'Loading templates: %.2f ms' % ((time.time() - start) * 1000)
+
+    formatDate = DateFormatter()
+    print 'Formatting with format_date(): %.2f ms' % timeit(
+        lambda: formatRows(result, format_date), args.repeat)
+    print 'Formatting with DateFormatter: %.2f ms' % timeit(
+        lambda: formatRows(result, formatDate), args.repeat)
+    rows = formatRows(result, formatDate)
+    print 'Rendering %d rows: %.2f ms' % (args.rows, timeit(
+        lambda: render(tmpl, rows), args.repeat))
+    html = render(tmpl, rows).encode('utf-8')
+    for encoding in compression.encodings:
+        print 'Compressing %d bytes with %s: %.2f ms, %d bytes' % (
+            len(html), encoding, timeit(
+                lambda: compression.compress(html, encoding), args.repeat),
+            len(compression.compress(html, encoding)))
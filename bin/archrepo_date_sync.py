@@ -5,13 +5,15 @@ import gevent
 import os
 
 from archrepo import config
+from archrepo.changes import notify, PACKAGES
 from archrepo.db_pool import buildPool
+from archrepo.pkginfo import isPackageFile
 
 
 files = set()
 def _walker(arg, dirname, fnames):
     for name in fnames:
-        if name.endswith('.pkg.tar.gz') or name.endswith('.pkg.tar.xz'):
+        if isPackageFile(name):
             _file = os.path.abspath(os.path.join(dirname, name))
             if not os.path.islink(_file):
                 files.add(_file)
@@ -32,7 +34,12 @@ def sync():
     for path in files.intersection(known):
         mtime = os.path.getmtime(path)
         with pool.cursor() as cur:
+            values = (datetime.datetime.utcfromtimestamp(mtime), to_id[path])
             cur.execute('UPDATE packages SET last_update=%s WHERE id=%s',
-                        (datetime.datetime.utcfromtimestamp(mtime), to_id[path]))
+                        values)
+            cur.execute('UPDATE latest_packages SET last_update=%s WHERE id=%s',
+                        values)
+            if cur.rowcount:
+                notify(cur, PACKAGES)
 
 gevent.spawn(sync).join()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+import gevent
+import os
+import sys
+
+from archrepo import config
+from archrepo.db_pool import buildPool
+from archrepo.pkginfo import isPackageFile
+from archrepo.repo import Processor
+
+
+files = set()
+def _walker(arg, dirname, fnames):
+    for name in fnames:
+        if isPackageFile(name):
+            _file = os.path.abspath(os.path.join(dirname, name))
+            if not os.path.islink(_file):
+                files.add(_file)
+os.path.walk(config.get('repository', 'path'), _walker, None)
+
+known = set()
+pool = buildPool()
+with pool.cursor() as cur:
+    cur.execute('SELECT file_path FROM packages')
+    for path, in cur.fetchall():
+        if path:
+            known.add(path.encode('utf-8'))
+
+p = Processor(pool=pool)
+p.serve()
+
+if not p.serving:
+    print 'Arch Repo is running, stop it first or use archrepo_sync.py'
+    sys.exit(1)
+
+def bulkImport():
+    paths = sorted(files.difference(known))
+    print 'Importing %d files...' % len(paths)
+    count = p.importAll(paths)
+    print 'Imported %d packages' % count
+    p.kill()
+
+gevent.spawn(bulkImport).join()
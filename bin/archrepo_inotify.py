@@ -1,25 +1,71 @@
 #!/usr/bin/env python
 
+import os
+import time
 from gevent_zeromq import zmq
 from pyinotify import WatchManager, Notifier, ProcessEvent
 
 from archrepo import config
+from archrepo.trace import newTraceId
 from archrepo.utils import getZmqContext
 
 
 class PrintEvents(ProcessEvent):
-    def __init__(self, pevent=None, **kargs):
+    def __init__(self, wm, path, mask, pevent=None, **kargs):
         super(PrintEvents, self).__init__(pevent, **kargs)
         self._socket = getZmqContext().socket(zmq.PUSH)
         self._socket.connect(config.get('repository', 'management-socket'))
+        self._wm = wm
+        self._path = path
+        self._mask = mask
+        self._unmounted = set()
+        self._remounts = set()
+
+    def watch(self, path):
+        self._wm.add_watch(path, self._mask, rec=True, auto_add=True)
+
+    def _send(self, *parts):
+        # Traced from here, the processor times the queue with the timestamp
+        self._socket.send_multipart(
+            ('traced', newTraceId(), '%.6f' % time.time()) + parts)
+
+    def _execute(self, method, *args):
+        self._send('execute', method, *args)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        # Events were dropped, the processor rescans the directories changed
+        # since its last scan, and new directories may not be watched yet
+        self._execute('rescan')
+        self.watch(self._path)
+
+    def process_IN_UNMOUNT(self, event):
+        # Every watched directory on the file system reports it
+        self._unmounted.add(event.pathname.rstrip('/'))
+
+    def checkMounts(self, notifier):
+        if self._unmounted:
+            for path in sorted(self._unmounted):
+                if not any(path.startswith(x + '/') for x in self._remounts):
+                    # Packages on it are gone, those under the mount point
+                    # are visible again
+                    self._remounts.add(path)
+                    self._execute('rescan', path)
+                    if os.path.isdir(path):
+                        self.watch(path)
+            self._unmounted.clear()
+        for path in list(self._remounts):
+            if os.path.ismount(path):
+                self._remounts.remove(path)
+                self._execute('rescan', path)
+                self.watch(path)
 
     def process_default(self, event):
-        self._socket.send_multipart((
+        self._send(
             'inotify',
             str(event.mask),
             str(event.cookie) if event.mask & (0x00000040 | 0x00000080) else '',
             str(event.dir),
-            event.pathname))
+            event.pathname)
 
 
 if __name__ == '__main__':
@@ -28,9 +74,6 @@ if __name__ == '__main__':
     # watch manager instance
     wm = WatchManager()
 
-    # notifier instance and init
-    notifier = Notifier(wm, default_proc_fun=PrintEvents())
-
     s = """
     FLAG_COLLECTIONS = {'OP_FLAGS': {
         'IN_ACCESS'        : 0x00000001,  # File was accessed
@@ -66,7 +109,11 @@ if __name__ == '__main__':
     # What mask to apply
     mask = 0x00000002 | 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
 
-    wm.add_watch(path, mask, rec=True, auto_add=True)
+    # notifier instance and init, wakes up every 5 seconds to check mounts
+    handler = PrintEvents(wm, path, mask)
+    notifier = Notifier(wm, default_proc_fun=handler, timeout=5000)
+
+    handler.watch(path)
 
     # Loop forever (until sigint signal get caught)
-    notifier.loop()
+    notifier.loop(callback=handler.checkMounts)
@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+
+from archrepo.db_pool import buildPool
+from archrepo.schema import rebuildLatest
+
+
+pool = buildPool()
+with pool.cursor() as cur:
+    count = rebuildLatest(cur)
+print 'Rebuilt latest_packages with %d packages' % count
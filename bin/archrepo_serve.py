@@ -1,14 +1,37 @@
 #!/usr/bin/env python
 
 import logging
+import sys
 from argparse import ArgumentParser
 
 
+def superviseWorker(listener, verbose, workers):
+    import gevent
+    from gevent import subprocess
+    while True:
+        # A fresh interpreter, it only takes over the listening socket
+        proc = subprocess.Popen(
+            (sys.executable, sys.argv[0], '-v', str(verbose),
+             '--listen-fd', str(listener.fileno())), close_fds=False)
+        workers.append(proc)
+        code = proc.wait()
+        workers.remove(proc)
+        logging.error('Web worker %d exited with %s, restarting',
+                      proc.pid, code)
+        gevent.sleep(1)
+
+
 if __name__ == '__main__':
     p = ArgumentParser('archrepo_serve.py')
     p.add_argument('-v', '--verbose', choices=[0, 1, 2], type=int, default=1,
                    help='Output verbose, 0 (default) for silent, 1 for info, '
                         '2 for everything')
+    p.add_argument('-w', '--workers', type=int, default=None,
+                   help='Number of web worker processes, default is the '
+                        'workers option in archrepo.ini, or 1 to serve web '
+                        'in the processor process')
+    p.add_argument('--listen-fd', type=int, default=None,
+                   help='Internal, run as a web worker on this socket')
     args = p.parse_args()
     if args.verbose == 0:
         logging.basicConfig(level=logging.ERROR)
@@ -24,14 +47,53 @@ if __name__ == '__main__':
     cherrypy.log.access_log.level = cherrypy.log.access_log.parent.level
     cherrypy.log.error_log.level = cherrypy.log.error_log.parent.level
 
+    from archrepo import config
     from archrepo.db_pool import buildPool
+    from archrepo.monitor import HubMonitor
+    from archrepo.trace import setupTraceLog
     from archrepo.repo import Processor
-    from archrepo.web import ArchRepoWebServer
+    from archrepo.web import ArchRepoWebServer, createListener
+
+    threshold = config.xgetint('web', 'block-threshold', 0)
+    if threshold > 0:
+        HubMonitor(threshold / 1000.0).start()
 
     pool = buildPool()
-    p = Processor(pool=pool)
+
+    if args.listen_fd is not None:
+        import socket
+        listener = socket.fromfd(args.listen_fd, socket.AF_INET,
+                                 socket.SOCK_STREAM)
+        web_server = ArchRepoWebServer(pool, listener)
+        try:
+            web_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    workers = args.workers or config.xgetint('web', 'workers', 1)
+    setupTraceLog()
+    standby = config.xgetbool('repository', 'standby', False)
+    p = Processor(pool=pool, standby=standby)
     p.serve()
-    if p.serving:
+    if not p.serving:
+        logging.critical('Another ArchRepo processor is working, try again later')
+    elif workers > 1:
+        import gevent
+        listener = createListener()
+        procs = []
+        supervisors = [gevent.spawn(superviseWorker, listener, args.verbose,
+                                    procs) for _ in xrange(workers)]
+        try:
+            gevent.joinall(supervisors)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            gevent.killall(supervisors)
+            for proc in procs:
+                proc.terminate()
+            p.kill()
+    else:
         web_server = ArchRepoWebServer(pool)
         try:
             web_server.serve_forever()
@@ -39,5 +101,3 @@ if __name__ == '__main__':
             pass
         finally:
             p.kill()
-    else:
-        logging.critical('Another ArchRepo processor is working, try again later')
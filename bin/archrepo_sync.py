@@ -5,14 +5,15 @@ import os
 
 from archrepo import config
 from archrepo.db_pool import buildPool
+from archrepo.pkginfo import isPackageFile
 from archrepo.repo import Processor
-from archrepo.repo import FakeProcessor
+from archrepo.repo import ManagementClient, ManagementError
 
 
 files = set()
 def _walker(arg, dirname, fnames):
     for name in fnames:
-        if name.endswith('.pkg.tar.gz') or name.endswith('.pkg.tar.xz'):
+        if isPackageFile(name):
             _file = os.path.abspath(os.path.join(dirname, name))
             if not os.path.islink(_file):
                 files.add(_file)
@@ -35,18 +36,38 @@ if p.serving:
 else:
     local = False
     print 'Connecting to Arch Repo management socket...'
-    p = FakeProcessor()
+    client = ManagementClient()
+
+def progress(path, error):
+    if error is not None:
+        print 'Failed', path, error
 
 def sync():
-    for path in files.difference(known):
+    added = sorted(files.difference(known))
+    deleted = sorted(known.difference(files))
+    if not local:
+        # One request each, the server runs them and reports back
+        for method, paths in (('complete', added), ('delete', deleted)):
+            if paths:
+                print '%s %d files...' % (
+                    'Adding' if method == 'complete' else 'Deleting',
+                    len(paths))
+                try:
+                    result = client.bulk(method, paths, progress)
+                except ManagementError as e:
+                    print 'Failed:', e
+                    return
+                print 'Done, %(failed)d of %(total)d failed' % result
+        return
+
+    for path in added:
         print 'Adding new file to repo', path
         p._complete(path)
 
-    for path in known.difference(files):
+    for path in deleted:
         print 'Deleting package from repo', path
         p._delete(path)
 
-    if local:
-        p.kill()
+    p.kill()
 
 gevent.spawn(sync).join()
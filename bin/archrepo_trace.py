@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+
+from archrepo.repo import ManagementClient
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser('archrepo_trace.py')
+    p.add_argument('query', metavar='QUERY',
+                   help='a file path, package name or trace ID')
+    args = p.parse_args()
+
+    traces = ManagementClient().call('traces', args.query)
+    if not traces:
+        print 'No recent traces of', args.query
+    for trace in traces:
+        print 'Trace %s: %s' % (trace['id'],
+                                ', '.join(trace['paths'] + trace['names']))
+        spans = sorted(trace['spans'], key=lambda x: x['start'])
+        begin = spans and spans[0]['start']
+        for span in spans:
+            extra = ' '.join(['%s=%s' % x for x in sorted(span.iteritems())
+                              if x[0] not in ('span', 'start', 'duration')])
+            print '  %s +%8.3fs %8.3fs  %s %s' % (
+                time.strftime('%H:%M:%S', time.localtime(span['start'])),
+                span['start'] - begin, span['duration'], span['span'], extra)
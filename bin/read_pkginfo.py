@@ -2,42 +2,33 @@
 
 import argparse
 import sys
-from gzip import GzipFile
-from lzma import LZMAFile
-from tarfile import TarFile
 import ujson
+from StringIO import StringIO
+
+from archrepo.pkginfo import DECODE_ERRORS, PACKAGE_SUFFIXES
+from archrepo.pkginfo import openPackage, readPkginfo
 
 
 def main(path, verify=False, format='json'):
     code = 0
 
     try:
-        if path.endswith('.pkg.tar.gz'):
-            f = GzipFile(path)
-        elif path.endswith('.pkg.tar.xz'):
-            f = LZMAFile(path)
-        else:
+        f = openPackage(path)
+        if f is None:
             print >> sys.stderr, path, 'does not look like a package file.'
             return 1
 
-        f = TarFile(fileobj=f)
-        while True:
-            info = f.next()
-            if info.name == '.PKGINFO':
-                break
-        else:
+        lines, complete = readPkginfo(f, verify)
+        if lines is None:
             print >> sys.stderr, path, 'does not contain .PKGINFO'
             return 1
 
-        if verify:
-            try:
-                f._load()
-            except IOError:
-                print >> sys.stderr, 'failed to verify', path
-                code = 2
+        if not complete:
+            print >> sys.stderr, 'failed to verify', path
+            code = 2
 
         ret = {}
-        for line in f.extractfile(info).readlines():
+        for line in lines:
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
@@ -55,19 +46,48 @@ def main(path, verify=False, format='json'):
 
         if format in ('json',):
             print ujson.dumps(ret)
-    except IOError:
+    except DECODE_ERRORS:
         print >> sys.stderr, path, 'is not a valid package file.'
         return 1
     else:
         return code
 
+
+def serve():
+    # One package per line, for the long running processes of a Verifier
+    stdout, stderr = sys.stdout, sys.stderr
+    for line in iter(sys.stdin.readline, ''):
+        sys.stdout, sys.stderr = out, err = StringIO(), StringIO()
+        try:
+            path, verify = ujson.loads(line)
+            code = main(path, verify)
+        except Exception as e:
+            # Only this request fails, the process keeps serving the queue
+            err.write('failed reading package: %s\n' % e)
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        stdout.write(ujson.dumps([code, out.getvalue(), err.getvalue()]))
+        stdout.write('\n')
+        stdout.flush()
+    return 0
+
+
 if __name__ == '__main__':
     p = argparse.ArgumentParser('read_pkginfo.py')
-    p.add_argument('package', metavar='PACKAGE', type=str, nargs=1,
-                   help='a package file ends with .pkg.tar.gz or .pkg.tar.xz')
+    p.add_argument('package', metavar='PACKAGE', type=str, nargs='?',
+                   help='a package file ends with ' +
+                        ', '.join(PACKAGE_SUFFIXES))
     p.add_argument('-f', '--format', choices=['json', 'pkginfo'],
                    default='json', help='choose the output format')
     p.add_argument('-v', '--verify', action='store_true',
                    help='verify the tarball completeness')
+    p.add_argument('--serve', action='store_true',
+                   help='read [PACKAGE, VERIFY] JSON lines from stdin and '
+                        'write [CODE, STDOUT, STDERR] JSON lines')
     args = p.parse_args()
-    sys.exit(main(args.package[0], args.verify, args.format))
+    if args.serve:
+        sys.exit(serve())
+    elif args.package is None:
+        p.error('PACKAGE is required')
+    sys.exit(main(args.package, args.verify, args.format))
@@ -31,7 +31,10 @@ setup(
              'bin/read_pkginfo.py',
              'bin/archrepo_serve.py',
              'bin/archrepo_sync.py',
+             'bin/archrepo_import.py',
+             'bin/archrepo_trace.py',
              'bin/archrepo_date_sync.py',
+             'bin/archrepo_rebuild_latest.py',
              ],
     package_data={'archrepo': ['templates/*.html', 'templates/static/*']},
     data_files=list(data_files.iteritems()),
@@ -41,7 +44,8 @@ setup(
     long_description=open('README.md').read(),
     install_requires=[
         "gevent>=1.0b3", "pyinotify", "ujson", "cherrypy", "jinja2", "psycopg2",
-        "babel", "pyliblzma", "gevent_zeromq"
+        "babel", "pyliblzma", "gevent_zeromq", "pysendfile",
+        "zstandard"
         ],
     cmdclass = {
         'build': my_build,